@@ -0,0 +1,177 @@
+from asyncio import TimeoutError, get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from io import BytesIO
+from urllib.parse import parse_qsl
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from aiohttp import ClientError, ClientSession, ClientTimeout
+from starlette.applications import Starlette
+from starlette.responses import RedirectResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+import webchat
+from process_chat import process_chat
+from session_interface import has_conversed, subscribe_log_async
+from storage import POOL_SIZE
+
+DB_WORKERS = POOL_SIZE  # threads for database work, one per pooled connection
+WSGI_WORKERS = 16  # threads for the routes still served by the Flask app, none of which wait on anything but the DB
+WELCOME_TIMEOUT = 10.0  # seconds to wait for the welcome chatbot
+
+_db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+
+async def run_db(func, *args):
+    """Run a function that uses the database in the database thread pool, so it can't block the event loop.
+
+    Everything a UnitOfWork does happens in one thread, so pass a function that does the whole unit of work.
+    """
+    return await get_running_loop().run_in_executor(_db_executor, partial(func, *args))
+
+
+async def request_values(request):
+    """Get the query string and form parameters of a request, preferring the query string like Flask does."""
+    values = {}
+    if request.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+        values.update(parse_qsl((await request.body()).decode(), keep_blank_values=True))
+    values.update(request.query_params)
+    return values
+
+
+def _login_redirect(scope):
+    with webchat.app.request_context(build_environ(scope, BytesIO())):
+        response = webchat.login_redirect()
+    return None if response is None else response.location
+
+
+async def authenticated(request):
+    """Check a request like webchat.authenticated does.
+
+    :returns: None if the request is authenticated, else a redirect to the login page.
+    """
+    location = await run_db(_login_redirect, request.scope)
+    return None if location is None else RedirectResponse(location, status_code=302)
+
+
+async def send_welcome_message(http, phone_num):
+    welcome = await run_db(webchat.welcome_request, phone_num)
+    if welcome is None:
+        return
+    url, data = welcome
+    try:
+        async with http.post(url, data=data) as response:
+            await response.read()
+    except (ClientError, TimeoutError):
+        return
+
+
+def _reply(base_url, session, message):
+    with webchat.app.test_request_context(base_url=base_url):  # so that image URLs can be built
+        return str(webchat.convert_to_twilio(process_chat(session, message)))
+
+
+async def sms_reply(request):
+    """Respond to Twilio SMS, like webchat.sms_reply, without holding a thread while waiting on the network."""
+    values = await request_values(request)
+    session = values.get('From')
+    if session is None:
+        return Response('Error. No phone number.', status_code=400)
+    if not await run_db(has_conversed, session):
+        await send_welcome_message(request.app.state.http, session)
+    reply = await run_db(_reply, str(request.base_url), session, webchat.inbound_message(values))
+    return Response(reply, media_type='text/html')
+
+
+def _image(scope):
+    environ = build_environ(scope, BytesIO())  # GET and HEAD requests have no body
+    with webchat.app.request_context(environ):
+        response = webchat.app.make_response(webchat.image())
+        app_iter, status, headers = response.get_wsgi_response(environ)  # drops the body of 304s and HEADs
+    return int(status.split(None, 1)[0]), [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                                           for key, value in headers], _close_after(app_iter, response)
+
+
+def _close_after(app_iter, response):
+    try:
+        yield from app_iter
+    finally:
+        response.close()
+
+
+async def image(request):
+    """Get an image, exactly as webchat.image would send it.
+
+    The image is looked up in the database thread pool, then streamed a block at a time, each read from the
+    file in Starlette's thread pool, so it is never held in memory whole.
+    """
+    status, headers, body = await run_db(_image, request.scope)
+    response = StreamingResponse(body, status_code=status)
+    response.raw_headers = headers  # Flask's, including the Content-Length
+    return response
+
+
+async def poll_for_stepin(request):
+    """Get a session's log lines after ``after``, like webchat.poll_for_stepin, without holding a thread."""
+    redirect = await authenticated(request)
+    if redirect is not None:
+        return redirect
+    values = await request_values(request)
+    try:
+        cursor, wait = webchat.stepin_cursor(values), webchat.long_poll_wait(values)
+    except ValueError as e:
+        return Response(str(e), status_code=400)
+
+    with subscribe_log_async(cursor.session) as subscription:  # subscribe first, so nothing logged meanwhile is missed
+        new_lines = await run_db(cursor.next_page)
+        if not new_lines and wait > 0 and await subscription.get(timeout=wait) is not None:
+            new_lines = await run_db(cursor.next_page)
+    body = webchat.app.json.response(new_lines)  # formatted exactly as jsonify would
+    return Response(body.get_data(), media_type=body.mimetype)
+
+
+async def stream_for_stepin(request):
+    """Stream a session's log lines, like webchat.stream_for_stepin, without holding a thread per stream."""
+    redirect = await authenticated(request)
+    if redirect is not None:
+        return redirect
+    values = await request_values(request)
+    try:
+        cursor = webchat.stepin_cursor(values, request.headers.get('Last-Event-ID'))
+    except ValueError as e:
+        return Response(str(e), status_code=400)
+
+    async def events():
+        with subscribe_log_async(cursor.session) as subscription:
+            steps = webchat.stepin_events(cursor)  # stepped in the database thread pool, since it reads the log
+            event = await run_db(next, steps)
+            while True:
+                if event is None:
+                    event = await run_db(steps.send, await subscription.get(timeout=webchat.STREAM_KEEPALIVE) is None)
+                else:
+                    yield event
+                    event = await run_db(next, steps)
+
+    return StreamingResponse(events(), media_type='text/event-stream', headers=webchat.STREAM_HEADERS)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    async with ClientSession(timeout=ClientTimeout(total=WELCOME_TIMEOUT)) as http:
+        app.state.http = http
+        yield
+
+
+app = Starlette(routes=[Route('/twilio_sms', sms_reply, methods=['GET', 'POST']),
+                        Route('/image', image, methods=['GET', 'HEAD']),
+                        Route('/stepin_poll', poll_for_stepin, methods=['GET']),
+                        Route('/stepin_stream', stream_for_stepin, methods=['GET']),
+                        Mount('/', WSGIMiddleware(webchat.app, workers=WSGI_WORKERS))],
+                lifespan=lifespan)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app)
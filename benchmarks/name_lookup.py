@@ -0,0 +1,47 @@
+"""Benchmark finding names in messages and loading the name index.
+
+Run from the repository root with ``python -m benchmarks.name_lookup``.
+"""
+from argparse import ArgumentParser
+from json import load
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from timeit import timeit
+
+import name_index
+from text_util import tokenize
+
+MESSAGES = {
+    'exact': "hey it's John",
+    'compound': 'I go by Anne Marie',
+    'two words': "I'm Mary Ann",
+    'misspelled': 'Christpher',
+    'no name': "not telling, what is this about?",
+}
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000, help='lookups per measurement')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as directory:
+        index_path = join(directory, 'names.idx')
+        start = perf_counter()
+        with open(name_index.NAMES_PATH) as f:
+            name_index.NameIndex(load(f))
+        print('parse JSON and build index: {:6.1f} ms'.format((perf_counter() - start) * 1e3))
+        name_index.build_index(index_path=index_path)
+        start = perf_counter()
+        index = name_index.load_index(index_path=index_path)
+        print('load precompiled index:     {:6.1f} ms'.format((perf_counter() - start) * 1e3))
+
+    for kind, message in MESSAGES.items():
+        seconds = timeit(lambda: index.find(tokenize(message)), number=args.number)
+        print('{:>10}: {:7.2f} us/message -> {!r}'.format(kind, seconds / args.number * 1e6,
+                                                          index.find(tokenize(message))))
+
+
+if __name__ == '__main__':
+    main()
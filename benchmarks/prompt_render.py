@@ -0,0 +1,38 @@
+"""Benchmark rendering exchange prompts with and without the template cache.
+
+Run from the repository root with ``python -m benchmarks.prompt_render``.
+"""
+from argparse import ArgumentParser
+from os.path import join
+from tempfile import TemporaryDirectory
+from timeit import timeit
+
+from jinja2 import Template
+
+import storage
+
+PROMPTS = {
+    'plain': 'Welcome to the Avenue! Reply with a direction to start walking.\nIMAGE(map.png)',
+    'templated': 'Nice to meet you, {{ name }}! {% if queued %}Hold tight.{% else %}Where to next?{% endif %}',
+}
+DATA = {'name': 'Jo', 'queued': False}
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000, help='renders per measurement')
+    args = parser.parse_args()
+    with TemporaryDirectory() as directory:
+        storage.configure(join(directory, 'bench.sqlite3'))
+        import exchange_translation
+        for name, text in PROMPTS.items():
+            exchange_translation.save_to_disk(name, text, {})
+        for name, text in PROMPTS.items():
+            before = timeit(lambda: Template(text).render(**DATA), number=args.number)
+            after = timeit(lambda: exchange_translation.prompt(name, DATA), number=args.number)
+            print('{:>9}: uncached {:8.2f} us/render, cached {:6.2f} us/render ({:.0f}x)'.format(
+                name, before / args.number * 1e6, after / args.number * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark database calls per inbound message with and without the session cache.
+
+Run from the repository root with ``python -m benchmarks.session_calls``.
+Each message goes through process_chat, so it is logged, matched against keywords, and answered. "uncached" turns
+off per-request state, so every get_session and set_session goes to the database, and every exchange lookup
+checks the exchange graph's version, as they used to.
+"""
+from argparse import ArgumentParser
+from collections import Counter
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import storage
+
+MESSAGES = ('hi', 'my name is Jo', 'cats please', 'dogs?', 'whatever')
+
+
+def count_statements(counter):
+    connect = storage.ConnectionPool._connect
+
+    def traced_connect(pool):
+        conn = connect(pool)
+        conn.set_trace_callback(lambda sql: counter.update([sql.split(None, 1)[0].upper()]))
+        return conn
+
+    storage.ConnectionPool._connect = traced_connect
+
+
+def run(label, process_chat, conversations, counter):
+    counter.clear()
+    start = perf_counter()
+    for i in range(conversations):
+        for message in MESSAGES:
+            process_chat('+1555{:07d}'.format(i), message)
+    elapsed = perf_counter() - start
+    total = conversations * len(MESSAGES)
+    print('{:>13}: {:5.1f} statements/msg ({:4.1f} SELECT, {:4.1f} write), {:6.3f} ms/msg'.format(
+        label, sum(counter.values()) / total, counter['SELECT'] / total,
+        (counter['INSERT'] + counter['REPLACE'] + counter['UPDATE'] + counter['DELETE']) / total,
+        elapsed / total * 1e3))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--conversations', type=int, default=200)
+    args = parser.parse_args()
+    counter = Counter()
+    with TemporaryDirectory() as directory:
+        count_statements(counter)
+        storage.configure(join(directory, 'bench.sqlite3'))
+        secrets = storage.Secrets()
+        for key in ('phone_number', 'account_sid', 'auth_token'):
+            secrets[key] = 'AC0' if key == 'account_sid' else 'x'
+
+        import exchange_translation
+        import session_interface
+        import webchat  # imports process_chat; importing that first is circular
+        from process_chat import process_chat
+        webchat.OUTBOUND.stop()
+        exchange_translation.save_to_disk('start', 'Hi! What is your name?', {}, 'getname', 0)
+        exchange_translation.save_to_disk('getname', '', {'yes_name': 'pets', 'no_name': 'pets'}, None, 1, 'name')
+        exchange_translation.save_to_disk('pets', 'Hi {{ name }}. Cats or dogs?', {'cat': 'cats', 'dog': 'dogs'},
+                                          'pets', 2)
+        exchange_translation.save_to_disk('cats', 'Meow.', {'question': 'pets'}, 'dogs', 3)
+        exchange_translation.save_to_disk('dogs', 'Woof.', {}, 'pets', 4)
+
+        session_interface.unit_of_work_state = exchange_translation.unit_of_work_state = lambda: None
+        run('uncached', process_chat, args.conversations, counter)
+        session_interface.unit_of_work_state = exchange_translation.unit_of_work_state = storage.unit_of_work_state
+        run('identity map', process_chat, args.conversations, counter)
+        session_interface.SESSION_CACHE = session_interface.SessionCache(10000, 60.0)
+        run('map + LRU', process_chat, args.conversations, counter)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Benchmark concurrent writers against the chat log and sessions tables.
+
+Run from the repository root with ``python -m benchmarks.storage_writers``.
+Each worker process plays the part of a webhook worker handling inbound messages:
+it logs the user's message, updates the session, and logs the bot's reply.
+"""
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import storage
+
+PROFILES = {'legacy': storage.LEGACY_PROFILE, 'tuned': storage.TUNED_PROFILE}
+
+
+def handle_messages(args):
+    path, profile_name, worker, messages = args
+    storage.configure(path, profile=PROFILES[profile_name])
+    chatlog = storage.ChatLog()
+    sessions = storage.Sessions()
+    errors = 0
+    for i in range(messages):
+        session = '+1555{:03d}{:04d}'.format(worker, i % 50)
+        try:
+            chatlog.log(session, 'message {}'.format(i), True)
+            sessions.set(session, 'exchange{}'.format(i), '{}')
+            chatlog.log(session, 'reply {}'.format(i), False)
+        except storage.sqlite3.OperationalError:
+            errors += 1
+    return errors
+
+
+def run(profile_name, workers, messages):
+    with TemporaryDirectory() as directory:
+        path = join(directory, 'bench.sqlite3')
+        storage.configure(path, profile=PROFILES[profile_name])
+        storage.ChatLog()
+        storage.Sessions()
+        start = perf_counter()
+        with Pool(workers) as pool:
+            errors = sum(pool.map(handle_messages, [(path, profile_name, w, messages) for w in range(workers)]))
+        elapsed = perf_counter() - start
+    total = workers * messages
+    print('{:>7}: {:6d} messages in {:6.2f}s = {:8.1f} msg/s, {} failed'.format(
+        profile_name, total, elapsed, total / elapsed, errors))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=250, help='messages per worker')
+    args = parser.parse_args()
+    for profile_name in PROFILES:
+        run(profile_name, args.workers, args.messages)
+
+
+if __name__ == '__main__':
+    main()
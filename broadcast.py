@@ -0,0 +1,163 @@
+from functools import lru_cache
+from os.path import isfile
+from re import split
+from string import digits
+from sys import stdout
+from time import sleep
+
+from exchange_translation import exchange_graph
+from process_chat import get_prompt
+from send_sms import send_message
+from session_interface import get_session, load_sessions, queued_sessions, set_session
+from storage import Outbox, Sessions, UnitOfWork
+
+OUTBOX = Outbox()
+SESSIONS = Sessions()
+
+PROGRESS_INTERVAL = 50  # sessions between progress reports while a broadcast is written
+PROGRESS_POLL = 1.0  # seconds between checks of how many messages have been sent
+
+
+def phone_number(entered, bypass=False):
+    """Turn a phone number as someone typed it into a session ID.
+
+    :param entered: The phone number, with or without punctuation.
+    :param bypass: Accept any digits as an international number (default: False).
+    :returns: The session ID, like +15555550100, or None if it isn't a valid US number.
+    """
+    id_digits = ''.join(d for d in entered if d in digits)
+    if bypass:
+        return '+' + id_digits
+    if len(id_digits) == 10:
+        return '+1' + id_digits
+    if len(id_digits) == 11 and id_digits[0] == '1':
+        return '+' + id_digits
+    return None
+
+
+def select_sessions(at_exchange=None, queued=False):
+    """Choose existing phone sessions to broadcast to.
+
+    :param at_exchange: Only choose sessions currently at this exchange (default: None).
+    :param queued: Only choose sessions waiting for an operator (default: False).
+    :returns: A list of session IDs.
+    """
+    if queued:
+        session_ids = [session_id for session_id, curr_exchange, _, _ in queued_sessions()
+                       if at_exchange is None or curr_exchange == at_exchange]
+    else:
+        session_ids = SESSIONS.ids(at_exchange)
+    return [session_id for session_id in session_ids if session_id.startswith('+')]
+
+
+def broadcast(session_ids, exchange, request_url, convert_func, data=None, send_prompt=True, progress=None):
+    """Move many sessions to an exchange at once, sending each of them its prompt.
+
+    The sessions are read with one query and written with one statement, in a single transaction that also
+    queues the messages, so either everyone is moved or no one is. The outbound queue's worker pool sends the
+    messages once the transaction commits.
+
+    :param session_ids: The IDs of the sessions, possibly not yet in existence.
+    :param exchange: The name of the exchange to move them to.
+    :param request_url: A URL of this website, for the links to any images.
+    :param convert_func: A function to convert each message, as for send_sms.send_message.
+    :param data: Data to add to the data of each session (default: None).
+    :param send_prompt: Whether to send each session the exchange's prompt (default: True).
+    :param progress: A function to call with (sessions done, total sessions) every PROGRESS_INTERVAL sessions
+        (default: None).
+    :returns: A list of the IDs of the queued messages, for :func:`broadcast_progress`.
+    """
+    if exchange not in exchange_graph().exchanges:
+        raise ValueError('Unknown exchange {!r}.'.format(exchange))
+    session_ids = list(dict.fromkeys(session_ids))
+    convert = lru_cache(maxsize=None)(convert_func)  # prompts are mostly identical, so convert each text once
+    message_ids = []
+    with UnitOfWork():
+        load_sessions(session_ids)
+        for done, session_id in enumerate(session_ids, 1):
+            _, session_data = get_session(session_id)
+            session_data.update(data or {})
+            set_session(session_id, exchange, session_data)
+            if send_prompt:
+                message_id = send_message(session_id, get_prompt(session_id, exchange, session_data), request_url,
+                                          convert)
+                if message_id is not None:
+                    message_ids.append(message_id)
+            if progress is not None and (done % PROGRESS_INTERVAL == 0 or done == len(session_ids)):
+                progress(done, len(session_ids))
+    return message_ids
+
+
+def broadcast_progress(message_ids):
+    """Check how many of a broadcast's messages have been sent.
+
+    :param message_ids: The IDs returned by :func:`broadcast`.
+    :returns: A dict mapping 'pending', 'sent', and 'failed' to counts.
+    """
+    return OUTBOX.progress(message_ids)
+
+
+def _read_numbers(entered):
+    if isfile(entered):
+        with open(entered) as f:
+            entered = f.read()
+    return [number.strip() for number in split(r'[,\n]', entered) if number.strip()]
+
+
+def _print_progress(done, total):
+    stdout.write('\rWrote {} of {} sessions.'.format(done, total))
+    stdout.flush()
+
+
+def main():
+    import webchat  # here, since webchat imports this module for its /broadcast endpoint
+
+    exchange = input('Exchange to send the sessions to: ').strip()
+    if exchange not in exchange_graph().exchanges:
+        print('There is no exchange named {!r}.'.format(exchange))
+        return
+    inp = ''
+    while inp not in ('n', 'e', 'q', 'a'):
+        inp = input('Send to a list of phone [n]umbers, the sessions at an [e]xchange, [q]ueued sessions, '
+                    'or [a]ll sessions? ').lower()[:1]
+    if inp == 'n':
+        numbers = _read_numbers(input('Enter phone numbers separated by commas, or the path of a file with one '
+                                      'per line: ').strip())
+        session_ids = [phone_number(number) for number in numbers]
+        invalid = [number for number, session_id in zip(numbers, session_ids) if session_id is None]
+        if invalid:
+            print('Skipping invalid numbers: {}'.format(', '.join(invalid)))
+        session_ids = [session_id for session_id in session_ids if session_id is not None]
+    elif inp == 'e':
+        session_ids = select_sessions(at_exchange=input('Exchange the sessions are at: ').strip())
+    else:
+        session_ids = select_sessions(queued=inp == 'q')
+    if not session_ids:
+        print('No sessions to send to.')
+        return
+
+    base_url = input('Address of this website, for links to images (like https://example.com): ').strip()
+    if input('Send {} sessions to {}? [y/n] '.format(len(session_ids), exchange)).lower()[:1] != 'y':
+        return
+    with webchat.app.test_request_context(base_url=base_url):
+        message_ids = broadcast(session_ids, exchange, base_url, webchat.convert_to_twilio_outbound,
+                                progress=_print_progress)
+    print()
+
+    print('Sending {} messages. Press Ctrl-C to stop waiting; the web app will send the rest.'.format(
+        len(message_ids)))
+    try:
+        while True:  # importing webchat started its outbound queue, so this process helps send them
+            counts = broadcast_progress(message_ids)
+            stdout.write('\rSent {sent}, failed {failed}, pending {pending}.'.format(**counts))
+            stdout.flush()
+            if not counts['pending']:
+                break
+            sleep(PROGRESS_POLL)
+    except KeyboardInterrupt:
+        pass
+    print()
+
+
+if __name__ == '__main__':
+    main()
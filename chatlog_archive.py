@@ -0,0 +1,148 @@
+import gzip
+from datetime import datetime, timedelta
+from json import dumps, loads
+from os import fsync, makedirs
+from os.path import dirname, join
+
+from storage import ChatLog, ChatLogArchive, CursorManager, UnitOfWork
+
+IDLE_DAYS = 90
+
+CHATLOG = ChatLog()
+ARCHIVE = ChatLogArchive()
+
+
+def archive_directory():
+    """Get the directory that holds the segment files, which is next to the database."""
+    return join(dirname(CursorManager.pool.path), 'archive')
+
+
+def archive_idle(days=IDLE_DAYS, directory=None):
+    """Move the logs of conversations that have been idle for a while into the archive.
+
+    :param days: How many days a conversation must have been idle (default: IDLE_DAYS).
+    :param directory: The directory of the segment files (default: archive_directory()).
+    :returns: A 2-tuple of (sessions archived, entries archived).
+    """
+    sessions = entries = 0
+    for session in CHATLOG.idle_sessions(datetime.now() - timedelta(days=days)):
+        count = archive_session(session, directory)
+        if count:
+            sessions += 1
+            entries += count
+    return sessions, entries
+
+
+def archive_session(session, directory=None):
+    """Move the log of one session into the archive.
+
+    The entries are appended to the segment for the month of the last one, as a gzip member of JSON lines.
+    This happens in a UnitOfWork, so the entries are only deleted once they are safely on disk, and archivers
+    in other processes wait their turn. If the unit of work rolls back, the bytes already written to the
+    segment are never indexed and so never read.
+
+    :param session: The session ID.
+    :param directory: The directory of the segment files (default: archive_directory()).
+    :returns: The number of entries archived.
+    """
+    directory = directory or archive_directory()
+    with UnitOfWork():
+        rows = CHATLOG.get_since(session, 0)
+        if not rows:
+            return 0
+        last_time = rows[-1][2]
+        data = gzip.compress(''.join(dumps([id_, text, is_from_user, int(timestamp.timestamp())]) + '\n'
+                                     for text, is_from_user, timestamp, id_ in rows).encode())
+        segment = 'chatlog-{:%Y-%m}.jsonl.gz'.format(last_time)
+        makedirs(directory, exist_ok=True)
+        with open(join(directory, segment), 'ab') as f:
+            offset = f.seek(0, 2)
+            f.write(data)
+            f.flush()
+            fsync(f.fileno())
+        ARCHIVE.add(session, segment, offset, len(data), len(rows), rows[0][3], rows[-1][3], last_time)
+        CHATLOG.delete_through(session, rows[-1][3])
+    return len(rows)
+
+
+def _read_run(directory, segment, offset, length):
+    with open(join(directory, segment), 'rb') as f:
+        f.seek(offset)
+        data = gzip.decompress(f.read(length))
+    return [loads(line) for line in data.decode().split('\n') if line]
+
+
+def read_session(session, after=0, directory=None):
+    """Read the archived entries of a session's log.
+
+    :param session: The session ID.
+    :param after: The ID of the last entry already seen (default: 0, for all of them).
+    :param directory: The directory of the segment files (default: archive_directory()).
+    :returns: A list of (message_contents, is_from_user, timestamp, id), oldest first.
+    """
+    runs = ARCHIVE.get(session, after)
+    if not runs:
+        return []
+    directory = directory or archive_directory()
+    return [(text, is_from_user, datetime.fromtimestamp(timestamp), id_)
+            for segment, offset, length in runs
+            for id_, text, is_from_user, timestamp in _read_run(directory, segment, offset, length)
+            if id_ > after]
+
+
+def verify(directory=None):
+    """Check that every archived run can be read back in full.
+
+    :param directory: The directory of the segment files (default: archive_directory()).
+    :returns: A 2-tuple of (runs checked, list of problems as str).
+    """
+    directory = directory or archive_directory()
+    checked, problems = 0, []
+    for session, segment, offset, length, message_count in ARCHIVE:
+        checked += 1
+        try:
+            count = len(_read_run(directory, segment, offset, length))
+        except (OSError, EOFError, ValueError) as e:
+            problems.append('{} at {}:{}: {}'.format(session, segment, offset, e))
+            continue
+        if count != message_count:
+            problems.append('{} at {}:{}: expected {} entries, found {}.'.format(session, segment, offset,
+                                                                                message_count, count))
+    return checked, problems
+
+
+def main():
+    inp = ''
+    while inp not in ('a', 'v'):
+        inp = input('Would you like to [a]rchive idle conversations or [v]erify the archive? ').lower()[:1]
+    if inp == 'a':
+        run_archive()
+    elif inp == 'v':
+        run_verify()
+
+
+def run_archive():
+    while True:
+        days = input('Archive conversations idle for how many days? [{}] '.format(IDLE_DAYS)) or IDLE_DAYS
+        try:
+            days = int(days)
+        except ValueError:
+            print('Please enter a whole number of days.')
+            continue
+        if days >= 0:
+            break
+        print('The number of days cannot be negative.')
+
+    sessions, entries = archive_idle(days)
+    print('Archived {} entries from {} conversations into {}.'.format(entries, sessions, archive_directory()))
+
+
+def run_verify():
+    checked, problems = verify()
+    for problem in problems:
+        print(problem)
+    print('Checked {} archived runs; {} problems.'.format(checked, len(problems)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,106 @@
+from collections import OrderedDict, namedtuple
+from re import compile
+from threading import Lock
+from types import MappingProxyType
+
 from jinja2 import Template
 
-from storage import Keywords, Prompts
+from keyword_matcher import KeywordMatcher
+from message_format import parse, static_images
+from storage import Keywords, Prompts, UnitOfWork, VersionedCache
 
 KEYWORDS = Keywords()
 PROMPTS = Prompts()
 
+VERSION_NAME = 'exchanges'
+TEMPLATE_CACHE_SIZE = 512
+
+Exchange = namedtuple('Exchange', ('name', 'prompt', 'default', 'type', 'rank', 'keywords', 'matcher', 'images'))
+ExchangeGraph = namedtuple('ExchangeGraph', ('version', 'exchanges', 'ranked'))
+
+_EMPTY_KEYWORDS = MappingProxyType({})
+_EMPTY_MATCHER = KeywordMatcher({})
+
+_templates = OrderedDict()  # (exchange name, prompt hash) -> jinja2.Template, or str for plain prompts
+_templates_lock = Lock()
+_TEMPLATE_SYNTAX = ('{{', '{%', '{#')
+_NEWLINES = compile(r'\r\n?')
+
+
+def _compile_graph(version):
+    """Read every Exchange from disk into a new ExchangeGraph, and drop the templates it makes stale."""
+    keyword_maps = {}
+    for exchange_name, keyword, destination in KEYWORDS:
+        keyword_maps.setdefault(exchange_name, {})[keyword] = destination
+    ranked = tuple(Exchange(name, prompt_, default_, type_, rank_,
+                            MappingProxyType(keyword_maps.get(name, {})), KeywordMatcher(keyword_maps.get(name, {})),
+                            static_images(prompt_ or ''))
+                   for name, prompt_, default_, rank_, type_ in PROMPTS.iter_all())
+    graph = ExchangeGraph(version, MappingProxyType({exch.name: exch for exch in ranked}), ranked)
+    _evict_templates(graph)
+    return graph
+
+
+_graph = VersionedCache(VERSION_NAME, 'exchange_graph', _compile_graph)
+
+
+def exchange_graph():
+    """Get the compiled, immutable graph of all Exchanges, rebuilt whenever any process edits them."""
+    return _graph.get()
+
+
+def _evict_templates(graph):
+    """Drop cached templates of Exchanges that were edited or deleted."""
+    with _templates_lock:
+        for key in list(_templates):
+            exch = graph.exchanges.get(key[0])
+            if exch is None or hash(exch.prompt) != key[1]:
+                del _templates[key]
+
+
+def _template(exchange_name, prompt_text):
+    """Get the compiled template of a prompt, from the cache if possible.
+
+    :returns: A jinja2.Template, or for prompts without any template syntax, the text jinja2 would render.
+    """
+    key = (exchange_name, hash(prompt_text))
+    with _templates_lock:
+        try:
+            _templates.move_to_end(key)
+            return _templates[key]
+        except KeyError:
+            pass
+    if any(syntax in prompt_text for syntax in _TEMPLATE_SYNTAX):
+        template = Template(prompt_text)
+    else:  # render it the way jinja2 would: normalized newlines, minus one trailing newline
+        template = _NEWLINES.sub('\n', prompt_text)
+        if template.endswith('\n'):
+            template = template[:-1]
+        parse(template)  # it will be sent just like this, so split it around its images now
+    with _templates_lock:
+        _templates[key] = template
+        if len(_templates) > TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+    return template
+
+
+def _get(exchange_name):
+    return exchange_graph().exchanges.get(exchange_name)
+
 
 def all_exchanges():
-    """Get the all Exchanges in the format (name, prompt, default)."""
-    return iter(PROMPTS)
+    """Get the all Exchanges in the format (name, prompt, default, type)."""
+    return iter([(exch.name, exch.prompt, exch.default, exch.type) for exch in exchange_graph().ranked])
+
+
+def images(exchange_name):
+    """Get the names of the images an Exchange's prompt always refers to.
+
+    :param exchange_name: The name of the Exchange.
+    :returns: A tuple of image names.
+    """
+    exch = _get(exchange_name)
+    return exch.images if exch else ()
 
 
 def default(exchange_name):
@@ -16,7 +108,8 @@ def default(exchange_name):
 
     :param exchange_name: The name of the Exchange.
     """
-    return PROMPTS.get_default(exchange_name)
+    exch = _get(exchange_name)
+    return exch.default if exch else None
 
 
 def delete(exchange_name):
@@ -24,8 +117,10 @@ def delete(exchange_name):
 
     :param exchange_name: The name of the Exchange.
     """
-    PROMPTS.delete(exchange_name)
-    KEYWORDS.delete(exchange_name)
+    with UnitOfWork():
+        PROMPTS.delete(exchange_name)
+        KEYWORDS.delete(exchange_name)
+        _graph.bump()
 
 
 def duplicate(old_name, new_name):
@@ -47,15 +142,27 @@ def exchange_type(exchange_name):
 
     :param exchange_name: The name of the Exchange.
     """
-    return PROMPTS.get_type(exchange_name)
+    exch = _get(exchange_name)
+    return exch.type if exch else None
 
 
 def keywords(exchange_name):
     """Get the keywords of an exchange.
 
     :param exchange_name: The name of the Exchange.
+    :returns: A read-only mapping of keywords to Exchange names.
     """
-    return KEYWORDS.get_mapping(exchange_name)
+    exch = _get(exchange_name)
+    return exch.keywords if exch else _EMPTY_KEYWORDS
+
+
+def matcher(exchange_name):
+    """Get the compiled KeywordMatcher for the keywords of an Exchange.
+
+    :param exchange_name: The name of the Exchange.
+    """
+    exch = _get(exchange_name)
+    return exch.matcher if exch else _EMPTY_MATCHER
 
 
 def prompt(exchange_name, data=None):
@@ -64,9 +171,12 @@ def prompt(exchange_name, data=None):
     :param exchange_name: The name of the Exchange.
     :param data: (optional) Data to render as parameters to jinja2.
     """
-    prompt_text = PROMPTS.get_prompt(exchange_name)
+    exch = _get(exchange_name)
+    prompt_text = exch.prompt if exch else None
     if data is not None:
-        template = Template(prompt_text)
+        template = _template(exchange_name, prompt_text)
+        if isinstance(template, str):
+            return template
         return template.render(**data)
     return prompt_text
 
@@ -76,7 +186,8 @@ def rank(exchange_name):
 
     :param exchange_name: The name of the Exchange.
     """
-    return PROMPTS.get_rank(exchange_name)
+    exch = _get(exchange_name)
+    return exch.rank if exch else None
 
 
 def save_to_disk(exchange_name, prompt_, keyword_map, default_=None, rank_=None, type_=None):
@@ -89,5 +200,7 @@ def save_to_disk(exchange_name, prompt_, keyword_map, default_=None, rank_=None,
     :param rank_: The Exchange's rank (default: None).
     :param type_: The Exchange's type (default: None).
     """
-    PROMPTS.set(exchange_name, prompt_, default_, rank_, type_)
-    KEYWORDS.set_many(exchange_name, keyword_map)
+    with UnitOfWork():
+        PROMPTS.set(exchange_name, prompt_, default_, rank_, type_)
+        KEYWORDS.set_many(exchange_name, keyword_map)
+        _graph.bump()
@@ -0,0 +1,281 @@
+from os import fsync, getpid, listdir, makedirs, remove, replace, utime
+from os.path import dirname, exists, getmtime, join
+from time import time
+
+from storage import CursorManager, ImageVariants, Images, UnitOfWork, VersionedCache
+
+IMAGES = Images()
+VARIANTS = ImageVariants()
+
+VERSION_NAME = 'images'
+GARBAGE_GRACE = 3600  # seconds an unreferenced file is kept, in case its image is still being saved
+
+
+class DatabaseBackend:
+    """Backend that keeps images as blobs in the images table."""
+    NAME = Images.DATABASE
+
+    def path(self, etag):
+        return None
+
+    def read(self, name, etag, start=0, length=-1):
+        return IMAGES.read(name, start, length)
+
+
+class FileBackend:
+    """Backend that keeps images as files named after their ETags, so identical images are only kept once.
+
+    Files are never changed once written, so they can be served straight from disk.
+    """
+    NAME = 'files'
+
+    def __init__(self, directory=None):
+        """Create a backend.
+
+        :param directory: Where to keep the files (default: an ``images`` directory next to the database).
+        """
+        self._directory = directory
+
+    @property
+    def directory(self):
+        return self._directory or join(dirname(CursorManager.pool.path), 'images')
+
+    def etags(self):
+        """Iterate over the ETags of all files in the store."""
+        if not exists(self.directory):
+            return
+        for prefix in listdir(self.directory):
+            for name in listdir(join(self.directory, prefix)):
+                if '.tmp' not in name:
+                    yield name
+
+    def path(self, etag):
+        """Get the path of the file holding an image."""
+        return join(self.directory, etag[:2], etag)
+
+    def put(self, image):
+        """Store an image, if an identical one isn't already stored.
+
+        An identical file that is already stored is touched, so that collect_garbage leaves it alone while the
+        image is being saved, even if it was unused until now.
+
+        :param image: The image, as bytes.
+        :returns: The ETag of the image.
+        """
+        etag = Images.etag(image)
+        path = self.path(etag)
+        try:
+            utime(path)
+        except FileNotFoundError:
+            makedirs(dirname(path), exist_ok=True)
+            temp_path = '{}.{}.tmp'.format(path, getpid())
+            with open(temp_path, 'wb') as f:
+                f.write(image)
+                f.flush()
+                fsync(f.fileno())
+            replace(temp_path, path)  # atomic, so a file is never seen half-written
+        return etag
+
+    def read(self, name, etag, start=0, length=-1):
+        with open(self.path(etag), 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+
+    def remove(self, etag):
+        remove(self.path(etag))
+
+
+BACKENDS = {backend.NAME: backend for backend in (DatabaseBackend(), FileBackend())}
+BACKEND = BACKENDS[FileBackend.NAME]  # for new images
+
+
+class EtagCache:
+    """Class to remember the ETags of images and their variants as of one version stamp.
+
+    ETags are looked up the first time they are asked for, and kept until the version stamp changes.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self._etags = {}
+
+    def get(self, name, variant=None):
+        """Get the ETag of an image, or of one of its variants.
+
+        :param name: The name of the image.
+        :param variant: The name of a variant (default: None, for the image itself).
+        :returns: The ETag, as image_meta would give it, or None if there's no such image.
+        """
+        key = (name, variant)
+        try:
+            return self._etags[key]
+        except KeyError:
+            meta = image_meta(name, variant)
+            etag = self._etags[key] = None if meta is None else meta[0]
+            return etag
+
+
+_etags = VersionedCache(VERSION_NAME, 'image_etags', EtagCache)
+
+
+def image_etags():
+    """Get the cached ETags of images, for naming their versions in URLs.
+
+    The cache is replaced whenever an image or variant is saved or removed by any process.
+
+    :returns: An EtagCache.
+    """
+    return _etags.get()
+
+
+def images_changed():
+    """Record that images or variants were saved or removed, so every process forgets their cached ETags.
+
+    Call this in the unit of work that changed them.
+    """
+    _etags.bump()
+
+
+def image_meta(name, variant=None):
+    """Get the details of an image, or of one of its variants.
+
+    :param name: The name of the image.
+    :param variant: The name of a variant, such as image_transcode.MMS (default: None, for the image itself).
+    :returns: A tuple of (etag, mimetype, size in bytes, modified datetime, backend), or None if there's no such
+        image. If the image has no such variant, the details of the image itself.
+    """
+    if variant is not None:
+        meta = VARIANTS.meta(name, variant)
+        if meta is not None:
+            return meta
+    return IMAGES.meta(name)
+
+
+def images_with_variant(variant):
+    """Get the names of the images that have a variant, such as image_transcode.THUMBNAIL.
+
+    :param variant: The name of the variant.
+    :returns: A set of image names.
+    """
+    return VARIANTS.names(variant)
+
+
+def remove_image(name):
+    """Remove an image and its variants.
+
+    :param name: The name of the image.
+    """
+    with UnitOfWork():
+        IMAGES.remove(name)
+        VARIANTS.delete(name)
+        images_changed()
+
+
+def save_image(name, image, mimetype, backend=None):
+    """Save an image. Any variants of an image it replaces are forgotten.
+
+    :param name: The name of the image.
+    :param image: The image, as bytes.
+    :param mimetype: The mimetype of the image.
+    :param backend: The backend to keep the image in (default: BACKEND).
+    """
+    backend = backend or BACKEND
+    with UnitOfWork():
+        if backend.NAME == Images.DATABASE:
+            IMAGES.set(name, image, mimetype)
+        else:
+            IMAGES.set_elsewhere(name, mimetype, backend.put(image), len(image), backend.NAME)
+        VARIANTS.delete(name)
+        images_changed()
+
+
+def image_path(meta):
+    """Get the path of the file holding an image, if it is kept in one.
+
+    :param meta: The image's details, from Images.meta.
+    :returns: The path, or None if the image must be read with :func:`read_image`.
+    """
+    return BACKENDS[meta[4]].path(meta[0])
+
+
+def read_image(name, meta, start=0, length=-1):
+    """Read part of an image.
+
+    :param name: The name of the image.
+    :param meta: The image's details, from Images.meta.
+    :param start: The offset of the first byte to read (default: 0).
+    :param length: The number of bytes to read, or -1 for the rest of the image (default: -1).
+    :returns: The bytes.
+    """
+    return BACKENDS[meta[4]].read(name, meta[0], start, length)
+
+
+def migrate(to=None):
+    """Move every image into one backend, one image per transaction.
+
+    :param to: The backend to move images into (default: BACKEND).
+    :returns: The number of images moved.
+    """
+    to = to or BACKEND
+    moved = 0
+    for from_name in BACKENDS:
+        if from_name == to.NAME:
+            continue
+        for name in IMAGES.names(from_name):
+            with UnitOfWork():
+                meta = IMAGES.meta(name)
+                if meta is None or meta[4] != from_name:  # deleted or moved since it was listed
+                    continue
+                image = read_image(name, meta)
+                if to.NAME == Images.DATABASE:
+                    IMAGES.move(name, to.NAME, image)
+                else:
+                    to.put(image)
+                    IMAGES.move(name, to.NAME)
+            moved += 1
+    return moved
+
+
+def collect_garbage(backend=None, grace=GARBAGE_GRACE):
+    """Delete files that no image or variant refers to any more, such as those of deleted or replaced images.
+
+    :param backend: The FileBackend to clean up (default: the 'files' backend).
+    :param grace: Only delete files older than this many seconds (default: GARBAGE_GRACE).
+    :returns: The number of files deleted.
+    """
+    backend = backend or BACKENDS[FileBackend.NAME]
+    referenced = IMAGES.etags(backend.NAME) | VARIANTS.etags(backend.NAME)
+    deleted = 0
+    for etag in list(backend.etags()):
+        if etag in referenced or not _is_stale(backend.path(etag), grace):
+            continue
+        # Check again in a unit of work: saves put their files inside their own, so none can commit meanwhile.
+        with UnitOfWork():
+            if (_is_stale(backend.path(etag), grace) and not IMAGES.uses(etag, backend.NAME)
+                    and not VARIANTS.uses(etag, backend.NAME)):
+                backend.remove(etag)
+                deleted += 1
+    return deleted
+
+
+def _is_stale(path, grace):
+    try:
+        return getmtime(path) < time() - grace
+    except FileNotFoundError:  # already deleted
+        return False
+
+
+def main():
+    inp = ''
+    while inp not in ('f', 'd', 'g'):
+        inp = input('Would you like to move images to [f]iles, move them back into the [d]atabase, '
+                    'or [g]arbage collect unused files? ').lower()[:1]
+    if inp == 'g':
+        print('Deleted {} unused files.'.format(collect_garbage()))
+        return
+    moved = migrate(BACKENDS[FileBackend.NAME if inp == 'f' else Images.DATABASE])
+    print('Moved {} images. Run VACUUM on the database to give the space they used back to the disk.'.format(moved))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from io import BytesIO
+from logging import getLogger
+
+from image_store import BACKENDS, IMAGES, VARIANTS, FileBackend, image_meta, images_changed, read_image
+from storage import UnitOfWork, after_commit
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it, images are sent as they were uploaded
+    Image = ImageOps = None
+
+LOGGER = getLogger(__name__)
+
+MMS = 'mms'  # a JPEG small enough for any carrier to deliver
+THUMBNAIL = 'thumb'  # a small JPEG for the /images page
+
+MMS_MAX_BYTES = 600 * 1024  # well under Twilio's 5 MB, since many carriers reject or recompress anything bigger
+MMS_MAX_DIMENSION = 1600
+MMS_QUALITIES = (85, 75, 65, 50)
+THUMBNAIL_SIZE = (200, 200)
+WORKERS = 2
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='transcode')
+
+
+def _flatten(img):
+    """Convert an image to RGB, putting anything transparent on a white background."""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+
+def _jpeg(img, quality):
+    out = BytesIO()
+    img.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+def transcode(image, mimetype):
+    """Make the variants of an image.
+
+    :param image: The image, as bytes.
+    :param mimetype: The mimetype of the image.
+    :returns: A dict mapping variant names to (bytes, mimetype). There is no MMS variant of an image that can
+        already be sent as it is, or of an animated one, which would lose its animation.
+    """
+    variants = {}
+    with Image.open(BytesIO(image)) as img:
+        animated = getattr(img, 'is_animated', False)
+        img = _flatten(ImageOps.exif_transpose(img))
+    thumbnail = img.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    variants[THUMBNAIL] = _jpeg(thumbnail, 80), 'image/jpeg'
+
+    if animated or (len(image) <= MMS_MAX_BYTES and max(img.size) <= MMS_MAX_DIMENSION
+                    and mimetype in ('image/jpeg', 'image/png', 'image/gif')):
+        return variants
+    dimension = MMS_MAX_DIMENSION
+    while True:
+        resized = img.copy()
+        resized.thumbnail((dimension, dimension))
+        for quality in MMS_QUALITIES:
+            data = _jpeg(resized, quality)
+            if len(data) <= MMS_MAX_BYTES:
+                variants[MMS] = data, 'image/jpeg'
+                return variants
+        dimension = dimension * 3 // 4
+
+
+def make_variants(name):
+    """Make and save the variants of an image, unless it is replaced or removed meanwhile.
+
+    :param name: The name of the image.
+    :returns: The names of the variants made.
+    """
+    meta = image_meta(name)
+    if meta is None or Image is None:
+        return []
+    variants = transcode(read_image(name, meta), meta[1])
+    backend = BACKENDS[FileBackend.NAME]  # variants can always be remade, so they needn't be in the database
+    stored = {variant: (backend.put(data), mimetype, len(data)) for variant, (data, mimetype) in variants.items()}
+    with UnitOfWork():
+        current = IMAGES.meta(name)
+        if current is None or current[0] != meta[0]:
+            return []
+        for variant, (etag, mimetype, size) in stored.items():
+            VARIANTS.set(name, variant, mimetype, etag, size, backend.NAME, meta[0])
+        images_changed()
+    return list(stored)
+
+
+def _make_variants_logged(name):
+    try:
+        make_variants(name)
+    except Exception:
+        LOGGER.exception('Error making variants of image %r.', name)
+
+
+def schedule_variants(name):
+    """Make the variants of an image in the background, once what has been written is committed.
+
+    :param name: The name of the image.
+    """
+    if Image is not None:
+        after_commit(partial(_executor.submit, _make_variants_logged, name))
+
+
+def main():
+    if Image is None:
+        print('Install Pillow to make image variants.')
+        return
+    made = 0
+    for name in list(IMAGES):
+        if not any(VARIANTS.meta(name, variant) for variant in (MMS, THUMBNAIL)):
+            try:
+                made += bool(make_variants(name))
+            except Exception as e:
+                print('Could not make variants of {!r}: {}'.format(name, e))
+    print('Made variants of {} images.'.format(made))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+from collections import deque
+
+from text_util import tokenize
+
+FIRST = 'first'  # the match that starts earliest in the message wins; ties go to the longer phrase
+LONGEST = 'longest'  # the longest phrase in the message wins; ties go to the one that starts earlier
+
+
+class KeywordMatcher:
+    """Class to find an Exchange's keywords, including multi-word phrases, in a message.
+
+    The keywords are compiled into an Aho-Corasick automaton over tokens, so matching takes a single pass over
+    the message no matter how many keywords there are.
+    """
+
+    def __init__(self, keyword_map):
+        """Compile a matcher.
+
+        :param keyword_map: A dict mapping keywords (single words or phrases) to Exchange names.
+        """
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [()]  # (phrase length, destination) for every phrase ending at each node
+        self.max_length = 0
+
+        phrases = {}
+        # If two keywords clean to the same tokens, the one that was already clean wins.
+        for keyword, destination in sorted(keyword_map.items(),
+                                           key=lambda item: ' '.join(tokenize(item[0])) != item[0]):
+            phrases.setdefault(tokenize(keyword), destination)
+        for phrase, destination in phrases.items():
+            if phrase:
+                self._add(phrase, destination)
+        self._link()
+
+    def _add(self, phrase, destination):
+        node = 0
+        for token in phrase:
+            child = self._goto[node].get(token)
+            if child is None:
+                child = len(self._goto)
+                self._goto[node][token] = child
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append(())
+            node = child
+        self._outputs[node] = ((len(phrase), destination),)
+        self.max_length = max(self.max_length, len(phrase))
+
+    def _link(self):
+        """Compute failure links breadth-first, merging in the outputs of each node's failure node."""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for token, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(token, 0)
+                self._outputs[child] += self._outputs[self._fail[child]]
+
+    def match(self, tokens, mode=FIRST):
+        """Find the keyword in a message.
+
+        With single-word keywords and the default mode this is the first word of the message that is a keyword.
+
+        :param tokens: The cleaned, lowercased words of the message.
+        :param mode: FIRST or LONGEST (default: FIRST).
+        :returns: The destination Exchange of the matching keyword, or None if there is no match.
+        """
+        best_key = best = None
+        node = 0
+        for end, token in enumerate(tokens):
+            while node and token not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(token, 0)
+            for length, destination in self._outputs[node]:
+                start = end - length + 1
+                key = (start, -length) if mode == FIRST else (-length, start)
+                if best_key is None or key < best_key:
+                    best_key, best = key, destination
+            if mode == FIRST and best_key is not None and end - self.max_length + 1 >= best_key[0]:
+                break  # nothing that ends later can start earlier
+        return best
@@ -0,0 +1,134 @@
+from asyncio import Queue as AsyncQueue, QueueFull, TimeoutError, get_running_loop, wait_for
+from collections import defaultdict
+from queue import Empty, Full, Queue
+from threading import Lock
+
+
+class Subscription:
+    """Class to receive the items published to one topic of a MessageBus.
+
+    Use it as a context manager so that it is unsubscribed when done.
+    """
+
+    def __init__(self, bus, topic, maxsize):
+        self.bus = bus
+        self.topic = topic
+        self.overflowed = False
+        self._queue = Queue(maxsize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.bus.unsubscribe(self)
+        return False
+
+    def get(self, timeout=None):
+        """Wait for the next item.
+
+        :param timeout: Seconds to wait (default: wait indefinitely).
+        :returns: The item, or None if the timeout passed first.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except Full:
+            self.overflowed = True  # the subscriber has fallen behind; it must catch up another way
+
+
+class AsyncSubscription(Subscription):
+    """Class to receive the items published to one topic of a MessageBus in an asyncio event loop.
+
+    Waiting for an item doesn't tie up a thread. Items are handed to the loop as they are published, from
+    whichever thread publishes them.
+    """
+
+    def __init__(self, bus, topic, maxsize, loop):
+        super().__init__(bus, topic, maxsize)
+        self._loop = loop
+        self._queue = AsyncQueue(maxsize)
+
+    async def get(self, timeout=None):
+        """Wait for the next item.
+
+        :param timeout: Seconds to wait (default: wait indefinitely).
+        :returns: The item, or None if the timeout passed first.
+        """
+        try:
+            return await wait_for(self._queue.get(), timeout)
+        except TimeoutError:
+            return None
+
+    def _put(self, item):
+        try:
+            self._loop.call_soon_threadsafe(self._put_in_loop, item)
+        except RuntimeError:  # the loop has closed
+            self.overflowed = True
+
+    def _put_in_loop(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except QueueFull:
+            self.overflowed = True
+
+
+class MessageBus:
+    """Class to pass items from publishers to any threads in this process that are waiting for them."""
+
+    def __init__(self, maxsize=1000):
+        """Create a bus.
+
+        :param maxsize: The most items to hold for a subscriber that isn't keeping up (default: 1000).
+        """
+        self.maxsize = maxsize
+        self._subscriptions = defaultdict(set)
+        self._lock = Lock()
+
+    def publish(self, topic, item):
+        """Hand an item to every current subscriber of a topic.
+
+        :param topic: The topic, such as a session ID.
+        :param item: The item to publish.
+        """
+        with self._lock:
+            subscriptions = tuple(self._subscriptions.get(topic, ()))
+        for subscription in subscriptions:
+            subscription._put(item)
+
+    def subscribe(self, topic):
+        """Subscribe to a topic.
+
+        :param topic: The topic, such as a session ID.
+        :returns: A Subscription.
+        """
+        return self._add(Subscription(self, topic, self.maxsize))
+
+    def subscribe_async(self, topic):
+        """Subscribe to a topic from a coroutine running in an asyncio event loop.
+
+        :param topic: The topic, such as a session ID.
+        :returns: An AsyncSubscription.
+        """
+        return self._add(AsyncSubscription(self, topic, self.maxsize, get_running_loop()))
+
+    def _add(self, subscription):
+        with self._lock:
+            self._subscriptions[subscription.topic].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop a subscription from receiving items.
+
+        :param subscription: A Subscription from :meth:`subscribe`.
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.topic)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.topic]
@@ -0,0 +1,41 @@
+from collections import namedtuple
+from functools import lru_cache
+from re import compile
+
+IMG_REGEX = compile(r'IMAGE\(([^)]+)\)')
+PARSE_CACHE_SIZE = 1024
+
+ParsedMessage = namedtuple('ParsedMessage', ('texts', 'images', 'text'))
+ParsedMessage.__doc__ = """A message split around its IMAGE(name) references.
+
+``texts`` has one more item than ``images``: texts[i] comes before images[i], and texts[-1] comes after the last
+image. Every text but the last is stripped of surrounding whitespace. ``text`` is the texts joined by spaces.
+"""
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse(message):
+    """Split a message around its image references.
+
+    The results are cached, so prompts that render to the same text every time are only parsed once.
+
+    :param message: The message, as text, where IMAGE(name.png) represents the image name.png.
+    :returns: A ParsedMessage.
+    """
+    texts, images = [], []
+    start = 0
+    for match in IMG_REGEX.finditer(message):
+        texts.append(message[start:match.start()].strip())
+        images.append(match.group(1))
+        start = match.end()
+    texts.append(message[start:])
+    return ParsedMessage(tuple(texts), tuple(images), ' '.join(texts))
+
+
+def static_images(prompt):
+    """Find the images a prompt always refers to, leaving out any whose names come from template syntax.
+
+    :param prompt: The prompt, before it is rendered.
+    :returns: A tuple of image names.
+    """
+    return tuple(name for name in IMG_REGEX.findall(prompt) if '{' not in name)
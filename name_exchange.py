@@ -1,23 +1,13 @@
-from json import dumps, load, loads
-from os.path import dirname, join
-
 from exchange_translation import keywords, prompt
-from storage import Sessions
-from text_util import clean
-
-SESSIONS = Sessions()
+from name_index import load_index
+from session_interface import get_session, set_session
 
-with open(join(dirname(__file__), 'static', 'names.json')) as f:
-    NAMES = {name.lower() for name in load(f)}
+NAMES = load_index()
 
 
-def name_exchange(session, message):
-    name = get_name(message)
-    curr_exchange, data = SESSIONS.get(session)
-    if data is None:
-        data = dict()
-    else:
-        data = loads(data)
+def name_exchange(session, message, tokens):
+    name = get_name(tokens)
+    curr_exchange, data = get_session(session)
     mapping = keywords(curr_exchange)
 
     if name:
@@ -26,12 +16,14 @@ def name_exchange(session, message):
     else:
         next_exch = mapping['no_name']
 
-    SESSIONS.set(session, next_exch, dumps(data))
+    set_session(session, next_exch, data)
     return prompt(next_exch, data)
 
 
-def get_name(message):
-    for word in clean(message).lower().split():
-        if word in NAMES:
-            return word.title()
-    return None
+def get_name(tokens):
+    """Find a first name in a message.
+
+    :param tokens: The words of the message, from text_util.tokenize.
+    :returns: The name, capitalized, or None if there isn't one.
+    """
+    return NAMES.find(tokens)
@@ -0,0 +1,211 @@
+import gzip
+from json import dump, load
+from os import getpid, replace
+from os.path import dirname, getmtime, join
+
+from storage import CursorManager
+from text_util import tokenize
+
+NAMES_PATH = join(dirname(__file__), 'static', 'names.json')
+INDEX_NAME = 'names.idx'  # kept next to the database, out of the public static directory
+
+MIN_FUZZY_LENGTH = 7  # shorter words are too often one edit away from a name: "really" is not Reilly
+MAX_FUZZY_TOKENS = 3  # only guess at misspellings in short replies, which are most likely just a name
+
+
+def edit_distance(a, b):
+    """Compute the edit distance between two strings, counting swapping two adjacent letters as one edit."""
+    previous, current = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, current = previous, current, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before[j - 2] + 1)
+    return current[len(b)]
+
+
+def _deletions(word, distance):
+    """Get every string that can be made by deleting up to ``distance`` letters from a word."""
+    variants = frontier = {word}
+    for _ in range(distance):
+        frontier = {variant[:i] + variant[i + 1:] for variant in frontier for i in range(len(variant))}
+        variants = variants | frontier
+    return variants
+
+
+class NameIndex:
+    """Class to recognize first names in messages.
+
+    Single words are looked up exactly in a dict. Hyphenated names such as "Anne-Marie" are also recognized
+    when written as two words or run together, as are names like "Maryann" written as two words ending in a
+    name, such as "Mary Ann". Misspellings are found through an index of every name with up
+    to ``max_distance`` letters deleted: a word and a name within that edit distance always share an entry.
+    """
+    FORMAT_VERSION = 2
+
+    def __init__(self, names, max_distance=1):
+        """Build an index.
+
+        :param names: An iterable of names, as in static/names.json.
+        :param max_distance: The largest edit distance at which a misspelled name is recognized (default: 1).
+        """
+        self.format_version = self.FORMAT_VERSION
+        self.max_distance = max_distance
+        self._exact = {}
+        self._phrases = {}
+        self._deletions = {}
+        self.max_phrase_length = 1
+        for name in names:
+            tokens = tokenize(name.replace('-', ' '))
+            if not tokens:
+                continue
+            if len(tokens) == 1:
+                self._exact.setdefault(tokens[0], tokens[0].title())
+            else:
+                self._phrases.setdefault(tokens, name)
+                self._exact.setdefault(''.join(tokens), name)
+                self.max_phrase_length = max(self.max_phrase_length, len(tokens))
+        for key in self._exact:
+            for variant in _deletions(key, max_distance):
+                self._deletions.setdefault(variant, []).append(key)
+        # newline-separated, so that a saved index loads straight from JSON
+        self._deletions = {variant: '\n'.join(keys) for variant, keys in self._deletions.items()}
+
+    def __contains__(self, word):
+        return word in self._exact
+
+    def __len__(self):
+        return len(self._exact)
+
+    def find(self, tokens, fuzzy=True):
+        """Find the first name in a message.
+
+        :param tokens: The words of the message, from text_util.tokenize.
+        :param fuzzy: Whether to look for misspelled names if there is no exact match (default: True). Even so,
+            only messages of up to MAX_FUZZY_TOKENS words are searched for words of MIN_FUZZY_LENGTH or more.
+        :returns: The name, capitalized, or None if there isn't one.
+        """
+        for i, token in enumerate(tokens):
+            for length in range(min(self.max_phrase_length, len(tokens) - i), 1, -1):
+                name = self._phrases.get(tuple(tokens[i:i + length]))
+                if name is None and tokens[i + length - 1] in self._exact:  # "to be" is not Tobe
+                    name = self._exact.get(''.join(tokens[i:i + length]))
+                if name is not None:
+                    return name
+            name = self._exact.get(token)
+            if name is not None:
+                return name
+        if fuzzy and len(tokens) <= MAX_FUZZY_TOKENS:
+            for token in tokens:
+                if len(token) >= MIN_FUZZY_LENGTH:
+                    name = self.closest(token)
+                    if name is not None:
+                        return name
+        return None
+
+    def closest(self, word):
+        """Find the name closest to a possibly misspelled word.
+
+        :param word: A lowercase word.
+        :returns: The closest name within ``max_distance`` edits that starts with the same letter, capitalized,
+            or None. Ties go to the name that comes first alphabetically.
+        """
+        candidates = set()
+        for variant in _deletions(word, self.max_distance):
+            keys = self._deletions.get(variant)
+            if keys:
+                candidates.update(keys.split('\n'))
+        best = None
+        for key in sorted(candidates):
+            if key[0] != word[0]:  # people rarely mistype the first letter of their own name
+                continue
+            distance = edit_distance(word, key)
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, key)
+        return None if best is None else self._exact[best[1]]
+
+    def save(self, f):
+        """Write the index to a binary file, as gzip-compressed JSON."""
+        with gzip.open(f, 'wt', encoding='utf-8') as out:
+            dump({'format_version': self.format_version,
+                  'max_distance': self.max_distance,
+                  'max_phrase_length': self.max_phrase_length,
+                  'exact': self._exact,
+                  'phrases': [list(tokens) + [name] for tokens, name in self._phrases.items()],
+                  'deletions': self._deletions},
+                 out, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, f):
+        """Read an index written by :meth:`save` from a binary file.
+
+        :returns: The NameIndex, or None if it was saved in another format version.
+        """
+        with gzip.open(f, 'rt', encoding='utf-8') as in_:
+            saved = load(in_)
+        if saved.get('format_version') != cls.FORMAT_VERSION:
+            return None
+        index = cls.__new__(cls)
+        index.format_version = saved['format_version']
+        index.max_distance = saved['max_distance']
+        index.max_phrase_length = saved['max_phrase_length']
+        index._exact = saved['exact']
+        index._phrases = {tuple(phrase[:-1]): phrase[-1] for phrase in saved['phrases']}
+        index._deletions = saved['deletions']
+        return index
+
+
+def default_index_path():
+    """Get the path of the saved name index, next to the database."""
+    return join(dirname(CursorManager.pool.path), INDEX_NAME)
+
+
+def build_index(names_path=NAMES_PATH, index_path=None):
+    """Build the name index from the names list and save it as a precompiled artifact.
+
+    :param names_path: The path of the names list (default: NAMES_PATH).
+    :param index_path: Where to save the index (default: default_index_path()).
+    :returns: The NameIndex.
+    """
+    index_path = index_path or default_index_path()
+    with open(names_path) as f:
+        index = NameIndex(load(f))
+    temp_path = '{}.{}.tmp'.format(index_path, getpid())
+    with open(temp_path, 'wb') as f:
+        index.save(f)
+    replace(temp_path, index_path)  # atomic, in case several workers start at once
+    return index
+
+
+def load_index(names_path=NAMES_PATH, index_path=None):
+    """Load the name index from its precompiled artifact, rebuilding the artifact if it is missing or stale.
+
+    :param names_path: The path of the names list (default: NAMES_PATH).
+    :param index_path: Where the index is saved (default: default_index_path()).
+    :returns: The NameIndex.
+    """
+    index_path = index_path or default_index_path()
+    try:
+        if getmtime(index_path) >= getmtime(names_path):
+            with open(index_path, 'rb') as f:
+                index = NameIndex.load(f)
+            if index is not None:
+                return index
+    except (OSError, EOFError, ValueError, KeyError, TypeError, IndexError):
+        pass
+    try:
+        return build_index(names_path, index_path)
+    except OSError:  # e.g. a read-only checkout; work from the names list directly
+        with open(names_path) as f:
+            return NameIndex(load(f))
+
+
+def main():
+    index = build_index()
+    print('Indexed {} names into {}.'.format(len(index), default_index_path()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps, loads
+from logging import getLogger
+from threading import Event, Thread
+from time import sleep, time
+
+from storage import Outbox, SendPace, UnitOfWork, after_commit
+
+LOGGER = getLogger(__name__)
+
+
+class OutboundQueue:
+    """Class to send outbound messages in the background.
+
+    Messages are written to the Outbox table, so they survive restarts, and sent by a thread pool. Each
+    recipient gets their messages in the order they were queued. Sends are paced through the database, so the
+    rate holds however many processes are sending from the same number. Failed sends are retried with exponential
+    backoff, except for errors Twilio says are the request's own fault, such as an invalid number.
+    """
+
+    def __init__(self, client, from_, rate=1.0, workers=4, batch_size=10, max_attempts=6, backoff=2.0, lease=60.0,
+                 poll_interval=1.0):
+        """Create a queue.
+
+        :param client: A twilio.rest.Client, or anything else with a compatible ``messages.create``.
+        :param from_: The phone number to send from.
+        :param rate: The most messages to send per second from this number, by all processes together, or None
+            for no limit (default: 1.0, Twilio's limit for a long code).
+        :param workers: The number of threads sending at once (default: 4).
+        :param batch_size: The most messages to claim from the outbox at once (default: 10). Fewer are claimed
+            if their turns to be sent wouldn't all come within half of ``lease``.
+        :param max_attempts: Attempts before giving up on a message (default: 6).
+        :param backoff: Seconds to wait after the first failure; doubled after each one (default: 2.0).
+        :param lease: Seconds before a message claimed by a sender that died is tried again (default: 60.0).
+        :param poll_interval: Seconds between checks of the outbox when idle (default: 1.0).
+        """
+        self.client = client
+        self.from_ = from_
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.interval = 1 / rate if rate else 0
+        self.outbox = Outbox()
+        self.pace = SendPace()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbound')
+        self._wake = Event()
+        self._stopping = Event()
+        self._thread = None
+
+    def enqueue(self, recipient, text, images):
+        """Queue a message to be sent.
+
+        Inside a UnitOfWork, the message is only sent if the unit of work commits.
+
+        :param recipient: The phone number of the recipient.
+        :param text: The contents of the message.
+        :param images: A list of image URLs.
+        :returns: The ID of the queued message.
+        """
+        id_ = self.outbox.enqueue(recipient, text, dumps(list(images)), time())
+        after_commit(self._wake.set)  # waking sooner would only block the sender behind the open transaction
+        return id_
+
+    def send_due(self):
+        """Send one batch of messages that are due, waiting until they have all been attempted.
+
+        :returns: The number of messages attempted.
+        """
+        now = time()
+        with UnitOfWork():  # claim the messages and their turns to be sent together
+            first_slot = max(now, self.pace.get(self.from_)) if self.interval else now
+            limit = self.batch_size
+            if self.interval:
+                limit = min(limit, int((now + self.lease / 2 - first_slot) // self.interval) + 1)
+            rows = self.outbox.claim(now, self.lease, limit) if limit > 0 else []
+            if rows and self.interval:
+                self.pace.set(self.from_, first_slot + len(rows) * self.interval)
+        slots = [first_slot + i * self.interval for i in range(len(rows))]
+        for _ in self._executor.map(self._send, rows, slots):
+            pass
+        return len(rows)
+
+    def _send(self, row, slot):
+        id_, recipient, body, media, attempts = row
+        attempts += 1
+        delay = slot - time()
+        if delay > 0:
+            sleep(delay)
+        try:
+            self.client.messages.create(body=body, media_url=loads(media), from_=self.from_, to=recipient)
+        except Exception as e:
+            status = getattr(e, 'status', None)
+            if attempts >= self.max_attempts or (isinstance(status, int) and 400 <= status < 500 and status != 429):
+                LOGGER.error('Giving up on message %s to %s after %s attempts: %s', id_, recipient, attempts, e)
+                self.outbox.mark_failed(id_, str(e))
+            else:
+                self.outbox.retry_later(id_, time() + self.backoff * 2 ** (attempts - 1), str(e))
+        else:
+            self.outbox.mark_sent(id_)
+
+    def run(self):
+        """Send messages until :meth:`stop` is called."""
+        while not self._stopping.is_set():
+            try:
+                attempted = self.send_due()
+            except Exception:
+                LOGGER.exception('Error sending queued messages.')
+                attempted = 0
+            if not attempted:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def start(self):
+        """Start sending messages from a background thread, if that isn't already happening."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = Thread(target=self.run, name='outbound-queue', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread after its current batch.
+
+        :param timeout: Seconds to wait for the thread to finish (default: wait indefinitely).
+        """
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
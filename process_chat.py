@@ -1,10 +1,10 @@
-import webchat
-from exchange_translation import default as default_func, exchange_type, keywords, prompt
+from exchange_translation import default as default_func, exchange_type, matcher, prompt
 from name_exchange import name_exchange
 from queue_exchange import queue_exchange, queue_exchange_prompt
 from session_interface import get_session, log, set_session
+from storage import UnitOfWork
 from tangent_exchange import tangent_exchange, tangent_exchange_prompt
-from text_util import clean
+from text_util import tokenize
 
 EXCHANGE_TYPES_NEXT = {'name': name_exchange, 'queue': queue_exchange, 'tangent': tangent_exchange}
 EXCHANGE_TYPES_PROMPT = {'queue': queue_exchange_prompt,
@@ -19,12 +19,13 @@ def process_chat(session, message):
     :param message: The user's message.
     :returns: The next message, if there is an appropriate one, otherwise None.
     """
-    log(session=session, message=message, is_from_user=True)
-    response = process_chat_real(session, message)
-    if response is not None:
-        response = autofollow(session, response)
-    if response is not None:
-        log(session=session, message=response, is_from_user=False)
+    with UnitOfWork():  # one transaction per inbound message
+        log(session=session, message=message, is_from_user=True)
+        response = process_chat_real(session, message)
+        if response is not None:
+            response = autofollow(session, response)
+        if response is not None:
+            log(session=session, message=response, is_from_user=False)
     return response
 
 
@@ -35,6 +36,8 @@ def autofollow(session, response):
     :param response: The response to proactively send if we are autofollowing.
     :returns: The final response
     """
+    import webchat  # here, since webchat imports this module
+
     while need_autofollow(session):
         webchat.send_message_wrapper(session, response)
         response = process_chat_real(session, '')
@@ -53,21 +56,19 @@ def process_chat_real(session, message):
         curr_exchange = 'start'
         set_session(session, 'start', data)
 
+    tokens = tokenize(message)
     exch_type = exchange_type(curr_exchange)
     try:
-        return EXCHANGE_TYPES_NEXT[exch_type](session, message)
+        return EXCHANGE_TYPES_NEXT[exch_type](session, message, tokens)
     except KeyError:
         pass
 
-    mapping = keywords(curr_exchange)
     new_exchange = default_func(curr_exchange)
-    cleaned_words = clean(message).lower().split()
     if '?' in message:
-        cleaned_words.append('question')
-    for mess_word in cleaned_words:
-        if mess_word in mapping:
-            new_exchange = mapping[mess_word]
-            break
+        tokens += ('question',)
+    matched_exchange = matcher(curr_exchange).match(tokens)
+    if matched_exchange is not None:
+        new_exchange = matched_exchange
 
     if new_exchange:
         set_session(session, new_exchange, data)
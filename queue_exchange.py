@@ -1,7 +1,7 @@
 from session_interface import get_session, set_session
 
 
-def queue_exchange(session_id, message):
+def queue_exchange(session_id, message, tokens):
     mark_queued(session_id, True)  # re-queue just in case
     return None  # no prompt
 
@@ -2,6 +2,7 @@ from urllib.parse import urlparse
 
 from twilio.rest import Client
 
+from outbound_queue import OutboundQueue
 from session_interface import log
 from storage import Secrets
 
@@ -15,23 +16,47 @@ except KeyError:
     raise Exception('Could not access Twilio authentication. Configure it with twilio_auth.py.')
 
 TWILIO = Client(ACCOUNT_SID, AUTH_TOKEN)
+OUTBOUND = OutboundQueue(TWILIO, PHONE_NUM)
 
 
 def send_sms(number, text, images):
-    """Send an SMS message using Twilio.
+    """Queue an SMS message to be sent using Twilio.
 
     :param number: The phone number of the recipient.
     :param text: The contents of the message.
     :param images: A list of image URLs.
+    :returns: The ID of the queued message.
     """
-    return TWILIO.messages.create(body=text, media_url=images, from_=PHONE_NUM, to=number)
+    return OUTBOUND.enqueue(number, text, images)
 
 
 def send_message(session, message, request_url, convert_func):
+    """Log a message to a session, and send it by SMS if the session is a phone number.
+
+    :param session: The session ID.
+    :param message: The message, as text.
+    :param request_url: A URL of this website, for the links to any images.
+    :param convert_func: A function taking the message and the website's base URL, and returning the keyword
+        arguments for :func:`send_sms`.
+    :returns: The ID of the queued SMS, or None if none was queued.
+    """
     if not message:
-        return
+        return None
     log(session=session, message=message, is_from_user=False)
     if session.startswith('+'):
         p = urlparse(request_url)
         absolute_base = '{}://{}'.format(p.scheme, p.netloc)
-        send_sms(session, **convert_func(message, absolute_base))
+        return send_sms(session, **convert_func(message, absolute_base))
+    return None
+
+
+def main():
+    print('Sending queued messages. Press Ctrl-C to stop.')
+    try:
+        OUTBOUND.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
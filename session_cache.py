@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class SessionCache:
+    """Class to keep the most recently used session states in memory for a limited time.
+
+    The cache only knows about writes made in this process, so with several worker processes a session may be
+    read up to ``ttl`` seconds out of date. Entries hold the data encoded, as it is stored, so callers can't
+    change them.
+    """
+
+    def __init__(self, size, ttl):
+        """Create a cache.
+
+        :param size: The most sessions to keep, or 0 to disable the cache.
+        :param ttl: Seconds to keep a session for after it was last loaded or written.
+        """
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def clear(self):
+        """Forget every session."""
+        with self._lock:
+            self._entries.clear()
+
+    def discard(self, session_id):
+        """Forget a session, if it is cached."""
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def get(self, session_id):
+        """Get the state of a session.
+
+        :param session_id: The ID of the session.
+        :returns: A 2-tuple of (current_exchange, encoded data or None), or None if it isn't cached.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return None
+            if entry[0] < monotonic():
+                del self._entries[session_id]
+                return None
+            self._entries.move_to_end(session_id)
+            return entry[1]
+
+    def put(self, session_id, current_exchange, data):
+        """Remember the state of a session.
+
+        :param session_id: The ID of the session.
+        :param current_exchange: The current exchange of the session.
+        :param data: The encoded data of the session, or None.
+        """
+        if not self.size:
+            return
+        with self._lock:
+            self._entries[session_id] = (monotonic() + self.ttl, (current_exchange, data))
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
@@ -0,0 +1,146 @@
+from json import dumps, loads
+
+from storage import Sessions, UnitOfWork
+
+SESSIONS = Sessions()
+
+MIGRATION_BATCH_SIZE = 1000
+
+
+class JsonCodec:
+    """Codec that stores session data as JSON text, as every session used to be stored."""
+    TAG = None  # JSON is stored as text rather than tagged bytes
+
+    def encode(self, data):
+        return dumps(data)
+
+    def decode(self, raw):
+        return loads(raw)
+
+
+class CompactCodec:
+    """Codec that stores the common keys of session data in a few bytes.
+
+    The format is the tag byte, a byte of flags for ``name`` and ``queued``, then the name as a two-byte
+    big-endian length and UTF-8, and finally any other keys as JSON. Sessions with only the common keys, which
+    is nearly all of them, are decoded without parsing any JSON.
+    """
+    TAG = 1
+    QUEUED = 1
+    QUEUED_TRUE = 2
+    NAME = 4
+
+    def encode(self, data):
+        rest = dict(data)
+        flags = 0
+        name = b''
+        if isinstance(rest.get('queued'), bool):
+            flags |= self.QUEUED | (self.QUEUED_TRUE if rest.pop('queued') else 0)
+        if isinstance(rest.get('name'), str):
+            name = rest['name'].encode()
+            if len(name) < 1 << 16:
+                flags |= self.NAME
+                name = len(name).to_bytes(2, 'big') + name
+                del rest['name']
+            else:
+                name = b''
+        return bytes((self.TAG, flags)) + name + (dumps(rest).encode() if rest else b'')
+
+    def decode(self, raw):
+        flags = raw[1]
+        data = {}
+        position = 2
+        if flags & self.NAME:
+            position = 4 + int.from_bytes(raw[2:4], 'big')
+            data['name'] = raw[4:position].decode()
+        if flags & self.QUEUED:
+            data['queued'] = bool(flags & self.QUEUED_TRUE)
+        if len(raw) > position:
+            data.update(loads(raw[position:]))
+        return data
+
+
+JSON = JsonCodec()
+COMPACT = CompactCodec()
+CODECS = {COMPACT.TAG: COMPACT}  # tag byte -> codec, for decoding
+CODEC = COMPACT  # for encoding
+
+
+def register(codec):
+    """Make a codec's format readable.
+
+    :param codec: An object with ``TAG``, a byte value not used by another codec, and ``encode`` and ``decode``
+        methods. ``encode`` takes a dict and returns bytes starting with ``TAG``; ``decode`` does the reverse.
+    """
+    if CODECS.get(codec.TAG, codec) is not codec:
+        raise ValueError('Tag {} is already used by {!r}.'.format(codec.TAG, CODECS[codec.TAG]))
+    CODECS[codec.TAG] = codec
+
+
+def encode(data, codec=None):
+    """Encode session data for storage.
+
+    :param data: The data of a session, as a dict.
+    :param codec: The codec to use (default: CODEC).
+    :returns: bytes, or str for JsonCodec.
+    """
+    return (codec or CODEC).encode(data)
+
+
+def decode(raw):
+    """Decode stored session data, in any format that has ever been used.
+
+    :param raw: The stored data: JSON text, tagged bytes, or None.
+    :returns: The data as a dict.
+    """
+    if raw is None:
+        return {}
+    if isinstance(raw, str):
+        return JSON.decode(raw)
+    try:
+        codec = CODECS[raw[0]]
+    except (KeyError, IndexError):
+        raise ValueError('Unknown session data format {!r}.'.format(raw[:1])) from None
+    return codec.decode(raw)
+
+
+def migrate(codec=None, batch_size=MIGRATION_BATCH_SIZE):
+    """Re-encode every stored session with a codec.
+
+    Each batch is rewritten in its own UnitOfWork, so the web app can keep running meanwhile.
+
+    :param codec: The codec to use (default: CODEC).
+    :param batch_size: The most sessions to rewrite per transaction (default: MIGRATION_BATCH_SIZE).
+    :returns: A 2-tuple of (sessions rewritten, sessions already in that format).
+    """
+    codec = codec or CODEC
+    rewritten = unchanged = 0
+    after = ''
+    while True:
+        with UnitOfWork():
+            page = SESSIONS.page(after, batch_size)
+            if not page:
+                break
+            updates = []
+            for session_id, _, raw in page:
+                encoded = encode(decode(raw), codec)
+                if encoded == raw:
+                    unchanged += 1
+                else:
+                    updates.append((session_id, encoded))
+            SESSIONS.set_data_many(updates)
+        rewritten += len(updates)
+        after = page[-1][0]
+    return rewritten, unchanged
+
+
+def main():
+    inp = ''
+    while inp not in ('c', 'j'):
+        inp = input('Would you like to convert session data to the [c]ompact format or back to [j]SON? ').lower()[:1]
+    rewritten, unchanged = migrate(COMPACT if inp == 'c' else JSON)
+    print('Rewrote {} sessions; {} were already converted.'.format(rewritten, unchanged))
+
+
+if __name__ == '__main__':
+    main()
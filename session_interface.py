@@ -1,10 +1,62 @@
-from json import dumps, loads
+from functools import partial
+from itertools import chain
+from time import time
 
-from storage import ChatLog, Sessions, TangentTracker
+from chatlog_archive import read_session as read_archived_log
+from session_cache import SessionCache
+from session_codec import decode, encode
+from storage import ChatLog, ChatLogArchive, Sessions, TangentTracker, after_commit, before_commit, \
+    unit_of_work_state
+
+SESSION_CACHE_SIZE = 0  # sessions to keep in memory between requests; 0 disables the cache
+SESSION_CACHE_TTL = 30.0  # seconds a cached session may be used for; bounds staleness with several processes
 
 SESSIONS = Sessions()
 CHATLOG = ChatLog()
+CHATLOG_ARCHIVE = ChatLogArchive()
 TANGENT_TRACKER = TangentTracker()
+SESSION_CACHE = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+def _identity_map():
+    """Get the sessions loaded in the current unit of work, keyed by ID, or None outside of one.
+
+    Each entry is a list of [current_exchange, data, dirty]. Dirty entries are written when the unit of work
+    commits, so a request that changes a session several times costs one write.
+    """
+    state = unit_of_work_state()
+    if state is None:
+        return None
+    sessions = state.get('sessions')
+    if sessions is None:
+        sessions = state['sessions'] = {}
+        before_commit(partial(_flush, sessions))
+    return sessions
+
+
+def _flush(sessions):
+    rows = []
+    for session_id, entry in sessions.items():
+        if entry[2]:
+            rows.append(_row(session_id, entry[0], entry[1]))
+            entry[2] = False
+    _write_many(rows)
+
+
+def _row(session_id, current_exchange, data):
+    return session_id, current_exchange, encode(data), time() if data.get('queued') else None
+
+
+def _write_many(rows):
+    """Write encoded sessions with one statement, caching them once the write is committed."""
+    if rows:
+        SESSIONS.set_many(rows)
+        after_commit(partial(_cache_many, rows))
+
+
+def _cache_many(rows):
+    for session_id, current_exchange, data, _ in rows:
+        SESSION_CACHE.put(session_id, current_exchange, data)
 
 
 def all_sessions():
@@ -12,12 +64,26 @@ def all_sessions():
 
     :returns: a 2-tuple of (session_id, current_exchange, data) where data is guaranteed to be a dict.
     """
+    sessions = _identity_map()
+    if sessions is not None:
+        _flush(sessions)
     for session_id, curr_exchange, data in SESSIONS:
-        if data is None:
-            data = {}
-        else:
-            data = loads(data)
-        yield session_id, curr_exchange, data
+        yield session_id, curr_exchange, decode(data)
+
+
+def queued_sessions(limit=-1):
+    """List the sessions waiting for an operator, longest waiting first.
+
+    A session is queued while its data has a true "queued" value, and keeps its place if it is queued again.
+
+    :param limit: The most sessions to return, or -1 for no limit (default: -1).
+    :returns: A list of (session_id, current_exchange, data, queued_at) where data is guaranteed to be a dict.
+    """
+    sessions = _identity_map()
+    if sessions is not None:
+        _flush(sessions)
+    return [(session_id, curr_exchange, decode(data), queued_at)
+            for session_id, curr_exchange, data, queued_at in SESSIONS.queue(limit)]
 
 
 def clear_session(session_id):
@@ -25,37 +91,74 @@ def clear_session(session_id):
 
     :param session_id: The ID of the session to clear.
     """
+    sessions = _identity_map()
+    if sessions is not None:
+        sessions.pop(session_id, None)
     SESSIONS.delete(session_id)
     TANGENT_TRACKER.clear_user(session_id)
+    SESSION_CACHE.discard(session_id)
+    after_commit(partial(SESSION_CACHE.discard, session_id))
 
 
 def get_session(session_id):
     """Get the state of a session.
 
+    Inside a UnitOfWork, every call for the same session returns the same data dict, including any changes
+    passed to set_session that haven't been written yet.
+
     :param session_id: The ID of the session, possibly not yet in existence.
     :returns: a 2-tuple of (current_exchange, data) where data is guaranteed to be a dict.
     """
-    curr_exchange, data = SESSIONS.get(session_id)
-    if data is None:
-        data = {}
-    else:
-        data = loads(data)
+    sessions = _identity_map()
+    if sessions is not None and session_id in sessions:
+        curr_exchange, data, _ = sessions[session_id]
+        return curr_exchange, data
+
+    cached = SESSION_CACHE.get(session_id)
+    if cached is None:
+        cached = SESSIONS.get(session_id)
+        SESSION_CACHE.put(session_id, *cached)
+    curr_exchange, data = cached[0], decode(cached[1])
+    if sessions is not None:
+        sessions[session_id] = [curr_exchange, data, False]
     return curr_exchange, data
 
 
+def load_sessions(session_ids):
+    """Load several sessions with one query, so that get_session needn't query for each of them.
+
+    This only helps inside a UnitOfWork; elsewhere it does nothing.
+
+    :param session_ids: The IDs of the sessions, possibly not yet in existence.
+    """
+    sessions = _identity_map()
+    if sessions is None:
+        return
+    to_load = set(session_ids).difference(sessions)
+    if not to_load:
+        return
+    loaded = SESSIONS.get_many(to_load)
+    for session_id in to_load:
+        curr_exchange, data = loaded.get(session_id, (None, None))
+        sessions[session_id] = [curr_exchange, decode(data), False]
+
+
 def set_session(session_id, current_exchange, data):
     """Set the state of a session.
 
+    Inside a UnitOfWork, the session is written when the unit of work commits; otherwise it is written now.
+
     :param session_id: The ID of the session, possibly not yet in existence.
     :param current_exchange: The current exchange of the session as a str.
     :param data: The data of the session, as a dict or None.
     """
     if data is None:
-        data = '{}'
+        data = {}
+    sessions = _identity_map()
+    if sessions is None:
+        _write_many([_row(session_id, current_exchange, data)])
     else:
-        data = dumps(data)
-
-    SESSIONS.set(session_id, current_exchange, data)
+        sessions[session_id] = [current_exchange, data, True]
 
 
 def log(session, message, is_from_user):
@@ -68,21 +171,79 @@ def log(session, message, is_from_user):
     CHATLOG.log(session=session, message=message, is_from_user=is_from_user)
 
 
-def all_logged_convos():
-    """Yield all conversations that have been logged.
+def logged_convo_summaries(after='', limit=-1):
+    """Summarize a page of the conversations that have been logged, in order of session ID.
+
+    :param after: The session ID at the end of the previous page (default: start from the beginning).
+    :param limit: The most conversations to return, or -1 for no limit (default: -1).
+    :returns: A list of (session_id, message_count, last_message_time), counting archived entries too.
+    """
+    merged = {}
+    for session, count, last_time in chain(CHATLOG_ARCHIVE.summaries(after, limit), CHATLOG.summaries(after, limit)):
+        if session in merged:
+            old_count, old_last_time = merged[session]
+            count, last_time = count + old_count, max(last_time, old_last_time)
+        merged[session] = count, last_time
+    summaries = [(session, count, last_time) for session, (count, last_time) in sorted(merged.items())]
+    return summaries if limit < 0 else summaries[:limit]
+
+
+def get_log_since(session, after, limit=-1):
+    """Get the entries in the log of a particular session that come after a given one.
 
-    :returns: An iterable with the IDs of all logged conversations.
+    :param session: The name of the session.
+    :param after: The ID of the last entry already seen, or 0 for the whole log.
+    :param limit: The most entries to return, or -1 for no limit (default: -1).
+    :returns: A list of (message, is_from_user, timestamp, id), including any archived entries.
+    """
+    archived = read_archived_log(session, after)
+    if archived:
+        if 0 <= limit <= len(archived):
+            return archived[:limit]
+        after = archived[-1][3]
+        if limit > 0:
+            limit -= len(archived)
+    return archived + CHATLOG.get_since(session, after, limit)
+
+
+class LogCursor:
+    """Class to read the log of a particular session a page at a time, moving past each page as it is read."""
+
+    def __init__(self, session, after, page_size=-1):
+        """Initialize a cursor.
+
+        :param session: The name of the session.
+        :param after: The ID of the last entry already seen, or 0 for the whole log.
+        :param page_size: The most entries to read at a time, or -1 for no limit (default: -1).
+        """
+        self.session = session
+        self.after = after
+        self.page_size = page_size
+
+    def next_page(self):
+        """Read the entries after the last one read, as :func:`get_log_since` returns them."""
+        page = get_log_since(self.session, self.after, self.page_size)
+        if page:
+            self.after = page[-1][3]
+        return page
+
+
+def subscribe_log(session):
+    """Subscribe to new entries in the log of a particular session, as they are committed.
+
+    :param session: The name of the session.
+    :returns: A message_bus.Subscription yielding (message, is_from_user, timestamp, id).
     """
-    return CHATLOG
+    return CHATLOG.bus.subscribe(session)
 
 
-def get_log(session):
-    """Get the log of a particular session.
+def subscribe_log_async(session):
+    """Subscribe to new entries in the log of a particular session from a coroutine, as they are committed.
 
     :param session: The name of the session.
-    :returns: An iterable of (message, is_from_user, timestamp).
+    :returns: A message_bus.AsyncSubscription yielding (message, is_from_user, timestamp, id).
     """
-    return CHATLOG.get(session)
+    return CHATLOG.bus.subscribe_async(session)
 
 
 def has_conversed(session):
@@ -91,6 +252,6 @@ def has_conversed(session):
     :param session: The session identifier, likely a phone number.
     :returns: A ``bool`` representing whether this user has conversed.
     """
-    for row in get_log(session):
+    for row in CHATLOG.get(session):
         return True
-    return False
+    return session in CHATLOG_ARCHIVE
@@ -1,30 +1,306 @@
+import atexit
 import sqlite3
+import threading
 from datetime import datetime, timedelta
+from functools import partial
+from hashlib import blake2b
+from json import dumps
 from os.path import dirname, join
+from queue import Empty, Full, LifoQueue
 from secrets import token_hex
+from time import sleep
+
+from message_bus import MessageBus
+
+DATABASE_PATH = join(dirname(__file__), 'chatbot.sqlite3')
+POOL_SIZE = 8
+
+
+class StorageProfile:
+    """Class to describe how connections to the database are tuned."""
+
+    def __init__(self, journal_mode='WAL', synchronous='NORMAL', mmap_size=64 * 1024 * 1024, cache_size=-16000,
+                 busy_timeout=5.0, busy_retries=5, busy_backoff=0.05):
+        """Create a profile.
+
+        :param journal_mode: The SQLite journal mode (default: 'WAL').
+        :param synchronous: The SQLite synchronous setting (default: 'NORMAL').
+        :param mmap_size: The number of bytes of the database to memory-map (default: 64 MiB).
+        :param cache_size: The page cache size, in pages, or in KiB if negative (default: -16000).
+        :param busy_timeout: Seconds SQLite itself waits on a locked database (default: 5.0).
+        :param busy_retries: Times to retry a statement that still fails because the database is locked
+            (default: 5).
+        :param busy_backoff: Seconds to wait before the first retry; doubled after each one (default: 0.05).
+        """
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.busy_timeout = busy_timeout
+        self.busy_retries = busy_retries
+        self.busy_backoff = busy_backoff
+
+    def apply(self, conn):
+        """Apply this profile's pragmas to a new connection."""
+        for pragma, value in (('journal_mode', self.journal_mode), ('synchronous', self.synchronous),
+                              ('mmap_size', self.mmap_size), ('cache_size', self.cache_size)):
+            retry_busy(self, conn.execute, 'PRAGMA {}={}'.format(pragma, value))
+
+    def __repr__(self):
+        return '{}(journal_mode={!r}, synchronous={!r})'.format(type(self).__name__, self.journal_mode,
+                                                                self.synchronous)
+
+
+TUNED_PROFILE = StorageProfile()
+LEGACY_PROFILE = StorageProfile(journal_mode='DELETE', synchronous='FULL', mmap_size=0, cache_size=-2000,
+                                busy_retries=0)
+
+
+def is_busy(error):
+    """Determine whether a sqlite3 error means the database was locked by someone else."""
+    return isinstance(error, sqlite3.OperationalError) and str(error).startswith(
+        ('database is locked', 'database table is locked'))
+
+
+def retry_busy(profile, func, *args):
+    """Call a function, retrying with exponential backoff while the database is locked.
+
+    :param profile: The StorageProfile giving the number of retries and the backoff.
+    :param func: The function to call, such as ``cursor.execute``.
+    :returns: Whatever the function returns.
+    """
+    delay = profile.busy_backoff
+    for _ in range(profile.busy_retries):
+        try:
+            return func(*args)
+        except sqlite3.OperationalError as e:
+            if not is_busy(e):
+                raise
+        sleep(delay)
+        delay *= 2
+    return func(*args)
+
+
+class _Cursor(sqlite3.Cursor):
+    """Cursor that retries statements that fail because the database is locked."""
+
+    def execute(self, sql, parameters=()):
+        return retry_busy(self.connection.profile, super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return retry_busy(self.connection.profile, super().executemany, sql, seq_of_parameters)
+
+
+class _Connection(sqlite3.Connection):
+    """Connection that remembers its StorageProfile and hands out retrying cursors."""
+    profile = LEGACY_PROFILE
+
+    def cursor(self, factory=_Cursor):
+        return super().cursor(factory)
+
+    def commit(self):
+        retry_busy(self.profile, super().commit)
+
+
+class ConnectionPool:
+    """Class to hand out reusable connections to a SQLite database.
+
+    Connections are created on demand and returned to the pool when released.
+    At most ``size`` idle connections are kept; any beyond that are closed.
+    """
+
+    def __init__(self, path, size=POOL_SIZE, profile=TUNED_PROFILE):
+        """Create a pool.
+
+        :param path: The path of the SQLite database.
+        :param size: The maximum number of idle connections to keep (default: POOL_SIZE).
+        :param profile: The StorageProfile applied to each new connection (default: TUNED_PROFILE).
+        """
+        self.path = path
+        self.size = size
+        self.profile = profile
+        self._idle = LifoQueue(maxsize=size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.profile.busy_timeout, check_same_thread=False,
+                               factory=_Connection)
+        conn.profile = self.profile
+        self.profile.apply(conn)
+        return conn
+
+    def acquire(self):
+        """Get an idle connection, or open a new one if none are available."""
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            return self._connect()
+
+    def release(self, conn):
+        """Return a connection to the pool, closing it if the pool is full.
+
+        :param conn: A connection previously obtained from :meth:`acquire`.
+        """
+        try:
+            self._idle.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                return
+
+
+_local = threading.local()
 
 
 class CursorManager:
     """Class to manage acquiring a cursor and committing afterward."""
-
-    @staticmethod
-    def _connection():
-        return sqlite3.connect(join(dirname(__file__), 'chatbot.sqlite3'))
+    pool = ConnectionPool(DATABASE_PATH)
 
     def __enter__(self):
         """Obtain a connection and cursor."""
-        self._conn = self._connection()
+        self._shared = getattr(_local, 'conn', None) is not None
+        self._conn = _local.conn if self._shared else self.pool.acquire()
         return self._conn.cursor()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """Commit the connection."""
-        self._conn.commit()
+        """Commit the connection, or roll it back if there was an error, and release it.
+
+        Inside a UnitOfWork this does nothing; the unit of work commits or rolls back when it ends.
+        """
+        if self._shared:
+            return False
+        try:
+            if exc_type is None:
+                self._conn.commit()
+        finally:
+            if self._conn.in_transaction:
+                self._conn.rollback()
+            self.pool.release(self._conn)
+            self._conn = None
         return False
 
 
+class UnitOfWork:
+    """Class to run all storage operations in a thread as a single transaction.
+
+    While a unit of work is active, every CursorManager in the same thread shares its connection and nothing is
+    committed until the outermost unit of work exits, so one request costs one commit and its reads and writes
+    are atomic. The transaction is started with BEGIN IMMEDIATE, so concurrent units of work take turns rather
+    than failing to upgrade their locks. Units of work may be nested.
+    """
+
+    def __enter__(self):
+        """Start a transaction, or join the one already in progress."""
+        depth = getattr(_local, 'depth', 0)
+        if depth == 0:
+            _local.before_commit = []
+            _local.after_commit = []
+            _local.state = {}
+            _local.pool = CursorManager.pool
+            _local.conn = _local.pool.acquire()
+            try:
+                _local.conn.cursor().execute('BEGIN IMMEDIATE')
+            except BaseException:
+                self._release()
+                raise
+        _local.depth = depth + 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Commit the transaction, or roll it back if there was an error, once the outermost unit of work ends."""
+        _local.depth -= 1
+        if _local.depth:
+            return False
+        committed = False
+        try:
+            if exc_type is None:
+                while _local.before_commit:  # a callback may write, and so register callbacks of its own
+                    _local.before_commit.pop(0)()
+                _local.conn.commit()
+                committed = True
+        finally:
+            if _local.conn.in_transaction:
+                _local.conn.rollback()
+            self._release()
+            _local.before_commit = _local.state = None
+        callbacks, _local.after_commit = _local.after_commit, None
+        if committed:
+            for callback in callbacks:
+                callback()
+        return False
+
+    @staticmethod
+    def _release():
+        _local.pool.release(_local.conn)
+        _local.conn = _local.pool = None
+
+
+def before_commit(callback):
+    """Call a function just before what has been written is committed.
+
+    Inside a UnitOfWork, the function is called as the outermost unit of work is about to commit, still inside
+    its transaction, and not at all if it rolls back. Otherwise, it is called right away.
+
+    :param callback: The function to call, with no arguments.
+    """
+    if getattr(_local, 'conn', None) is None:
+        callback()
+    else:
+        _local.before_commit.append(callback)
+
+
+def unit_of_work_state():
+    """Get a dict to keep state in for as long as the current unit of work lasts.
+
+    :returns: A dict shared by everything in the outermost UnitOfWork of this thread, or None outside of one.
+    """
+    return getattr(_local, 'state', None)
+
+
+def after_commit(callback):
+    """Call a function once what has just been written is committed.
+
+    Inside a UnitOfWork, the function is called when the outermost unit of work commits, and not at all if it
+    rolls back. Otherwise, writes are committed as they are made, so the function is called right away.
+
+    :param callback: The function to call, with no arguments.
+    """
+    if getattr(_local, 'conn', None) is None:
+        callback()
+    else:
+        _local.after_commit.append(callback)
+
+
+def configure(path=None, pool_size=None, profile=None):
+    """Change the database, pool size or profile used by all storage classes.
+
+    Storage instances created before this is called keep their tables in the old database,
+    so call it before importing modules that create them.
+
+    :param path: The path of the SQLite database (default: unchanged).
+    :param pool_size: The maximum number of idle connections to keep (default: unchanged).
+    :param profile: The StorageProfile for new connections (default: unchanged).
+    """
+    old_pool = CursorManager.pool
+    CursorManager.pool = ConnectionPool(path or old_pool.path, pool_size or old_pool.size,
+                                        profile or old_pool.profile)
+    old_pool.close()
+
+
+atexit.register(lambda: CursorManager.pool.close())
+
+
 class Storage:
     TABLE_NAME = None
     TABLE_SCHEMA = ''
+    # Each migration is a tuple of SQL statements in which {tab} stands for TABLE_NAME. Migrations are applied
+    # once, in order, and only ever appended to.
+    MIGRATIONS = ()
 
     @property
     def cursor(self):
@@ -34,9 +310,25 @@ class Storage:
         if self.TABLE_NAME is None:
             raise NotImplementedError('`TABLE_NAME` needs to be specified.')
         with self.cursor as cursor:
+            if not cursor.connection.in_transaction:
+                cursor.execute('BEGIN IMMEDIATE')  # keep other processes from migrating at the same time
             cursor.execute(
                 'CREATE TABLE IF NOT EXISTS {} ({})'.format(self.TABLE_NAME,
                                                             self.TABLE_SCHEMA))
+            self._migrate(cursor)
+
+    def _migrate(self, cursor):
+        """Apply any migrations this table hasn't had yet."""
+        cursor.execute('CREATE TABLE IF NOT EXISTS schema_versions '
+                       '(table_name TEXT PRIMARY KEY NOT NULL, version INTEGER NOT NULL)')
+        row = cursor.execute('SELECT version FROM schema_versions WHERE table_name=?', (self.TABLE_NAME,)).fetchone()
+        version = row[0] if row else 0
+        if version >= len(self.MIGRATIONS):
+            return
+        for migration in self.MIGRATIONS[version:]:
+            for statement in migration:
+                cursor.execute(statement.format(tab=self.TABLE_NAME))
+        cursor.execute('REPLACE INTO schema_versions VALUES (?, ?)', (self.TABLE_NAME, len(self.MIGRATIONS)))
 
     def __len__(self):
         with self.cursor as cursor:
@@ -58,14 +350,15 @@ class Storage:
 
     def _iterate_column(self, column_name):
         with self.cursor as cursor:
-            return (row[0] for row in cursor.execute(
-                'SELECT {col} from {tab} ORDER BY {col} ASC'.format(
-                    col=column_name,
-                    tab=self.TABLE_NAME)))
+            for row in cursor.execute(
+                    'SELECT {col} from {tab} ORDER BY {col} ASC'.format(
+                        col=column_name,
+                        tab=self.TABLE_NAME)):
+                yield row[0]
 
     def _iterate_columns(self, *columns, order_by=''):
         with self.cursor as cursor:
-            return cursor.execute(
+            yield from cursor.execute(
                 'SELECT {cols} from {tab} {order}'.format(cols=', '.join(columns),
                                                           tab=self.TABLE_NAME,
                                                           order=order_by))
@@ -83,19 +376,61 @@ class Storage:
             cursor.execute(
                 'CREATE TABLE IF NOT EXISTS {} ({})'.format(self.TABLE_NAME,
                                                             self.TABLE_SCHEMA))
+            cursor.execute('DELETE FROM schema_versions WHERE table_name=?', (self.TABLE_NAME,))
+            self._migrate(cursor)
 
 
 class ChatLog(Storage):
-    """Class to represent logged chats."""
+    """Class to represent logged chats.
+
+    Each new log entry is published to ``bus``, under its session ID, as (message_contents, is_from_user,
+    timestamp, id) once it is committed.
+    """
     TABLE_NAME = 'chatlog'
-    TABLE_SCHEMA = ('session_id TEXT NOT NULL, '
+    TABLE_SCHEMA = ('id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, '
+                    'session_id TEXT NOT NULL, '
                     'message_contents TEXT NOT NULL, '
                     'user_message INTEGER NOT NULL, '
                     'message_time DATETIME NOT NULL')
+    MIGRATIONS = (
+        ('CREATE INDEX IF NOT EXISTS {tab}_session_time ON {tab} (session_id, message_time)',),
+        # Give entries a stable id to page by; a plain rowid may be renumbered by VACUUM.
+        ('CREATE TABLE {tab}_new (id INTEGER PRIMARY KEY NOT NULL, session_id TEXT NOT NULL, '
+         'message_contents TEXT NOT NULL, user_message INTEGER NOT NULL, message_time DATETIME NOT NULL)',
+         'INSERT INTO {tab}_new (id, session_id, message_contents, user_message, message_time) '
+         'SELECT rowid, session_id, message_contents, user_message, message_time FROM {tab}',
+         'DROP TABLE {tab}',
+         'ALTER TABLE {tab}_new RENAME TO {tab}',
+         'CREATE INDEX IF NOT EXISTS {tab}_session_time ON {tab} (session_id, message_time)',
+         'CREATE INDEX IF NOT EXISTS {tab}_session ON {tab} (session_id, id)'),
+        # Never reuse the id of an entry that was deleted, such as by archiving; it may still be read from the archive.
+        ('CREATE TABLE {tab}_new (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, session_id TEXT NOT NULL, '
+         'message_contents TEXT NOT NULL, user_message INTEGER NOT NULL, message_time DATETIME NOT NULL)',
+         'INSERT INTO {tab}_new SELECT id, session_id, message_contents, user_message, message_time FROM {tab}',
+         'DROP TABLE {tab}',
+         'ALTER TABLE {tab}_new RENAME TO {tab}',
+         'CREATE INDEX IF NOT EXISTS {tab}_session_time ON {tab} (session_id, message_time)',
+         'CREATE INDEX IF NOT EXISTS {tab}_session ON {tab} (session_id, id)'),
+    )
+    bus = MessageBus()
 
     def __iter__(self):
         """Iterate over all known chat logs, returning their session IDs."""
-        return iter(set(self._iterate_column('session_id')))
+        with self.cursor as cursor:
+            for row in cursor.execute('SELECT DISTINCT session_id FROM {} ORDER BY session_id'.format(
+                    self.TABLE_NAME)):
+                yield row[0]
+
+    def delete_through(self, session, last_id):
+        """Delete the entries of a session's log up to and including a given one.
+
+        :param session: The session identifier.
+        :param last_id: The ID of the last entry to delete.
+        :returns: The number of entries deleted.
+        """
+        with self.cursor as cursor:
+            return cursor.execute('DELETE FROM {} WHERE session_id=? AND id<=?'.format(self.TABLE_NAME),
+                                  (session, last_id)).rowcount
 
     def get(self, session):
         """Get the log of a session.
@@ -106,11 +441,51 @@ class ChatLog(Storage):
         with self.cursor as cursor:
             for text, is_from_user, timestamp in cursor.execute(
                     'SELECT message_contents, user_message, message_time FROM {tab} WHERE session_id=? '
-                    'ORDER BY message_time ASC'.format(
+                    'ORDER BY message_time ASC, id ASC'.format(
                         tab=self.TABLE_NAME),
                     (session,)):
                 yield text, bool(is_from_user), datetime.fromtimestamp(timestamp)
 
+    def get_since(self, session, after, limit=-1):
+        """Get the entries of a session's log that were added after a given one.
+
+        :param session: The session identifier.
+        :param after: The ID of the last entry already seen, or 0 for the whole log.
+        :param limit: The most entries to return, or -1 for no limit (default: -1).
+        :returns: A list of (message_contents, is_from_user, timestamp, id), oldest first.
+        """
+        with self.cursor as cursor:
+            return [(text, bool(is_from_user), datetime.fromtimestamp(timestamp), id_)
+                    for id_, text, is_from_user, timestamp in cursor.execute(
+                        'SELECT id, message_contents, user_message, message_time FROM {tab} '
+                        'WHERE session_id=? AND id>? ORDER BY id ASC LIMIT ?'.format(tab=self.TABLE_NAME),
+                        (session, after, limit))]
+
+    def summaries(self, after='', limit=-1):
+        """Summarize the logged conversations, a page at a time, in order of session ID.
+
+        :param after: The session ID at the end of the previous page (default: start from the beginning).
+        :param limit: The most conversations to return, or -1 for no limit (default: -1).
+        :returns: A list of (session_id, message_count, last_message_time).
+        """
+        with self.cursor as cursor:
+            return [(session, count, datetime.fromtimestamp(last_time))
+                    for session, count, last_time in cursor.execute(
+                        'SELECT session_id, Count(*), MAX(message_time) FROM {tab} WHERE session_id>? '
+                        'GROUP BY session_id ORDER BY session_id LIMIT ?'.format(tab=self.TABLE_NAME),
+                        (after, limit))]
+
+    def idle_sessions(self, before):
+        """List the sessions whose last log entry is older than a given time.
+
+        :param before: The cutoff, as a datetime.
+        :returns: A list of session IDs.
+        """
+        with self.cursor as cursor:
+            return [row[0] for row in cursor.execute(
+                'SELECT session_id FROM {} GROUP BY session_id HAVING MAX(message_time)<? ORDER BY session_id'.format(
+                    self.TABLE_NAME), (int(before.timestamp()),))]
+
     def log(self, session, message, is_from_user):
         """Add a log entry.
 
@@ -118,10 +493,85 @@ class ChatLog(Storage):
         :param message: The message contents as str.
         :param is_from_user: Whether or not the message is from the user, as a bool.
         """
+        timestamp = int(datetime.now().timestamp())
         with self.cursor as cursor:
-            cursor.execute('INSERT INTO {} VALUES (?, ?, ?, ?)'.format(
+            cursor.execute('INSERT INTO {} VALUES (NULL, ?, ?, ?, ?)'.format(
                 self.TABLE_NAME),
-                (session, message, is_from_user, int(datetime.now().timestamp())))
+                (session, message, is_from_user, timestamp))
+            id_ = cursor.lastrowid
+        after_commit(partial(self.bus.publish, session,
+                             (message, bool(is_from_user), datetime.fromtimestamp(timestamp), id_)))
+
+
+class ChatLogArchive(Storage):
+    """Class to index the chat log entries that have been moved out to compressed segment files.
+
+    Each archived run of a session's log is stored as one gzip member of a segment file, at ``offset`` and
+    ``length`` bytes, so it can be read back without decompressing the rest of the segment.
+    """
+    TABLE_NAME = 'chatlog_archive'
+    TABLE_SCHEMA = ('session_id TEXT NOT NULL, '
+                    'segment TEXT NOT NULL, '
+                    'offset INTEGER NOT NULL, '
+                    'length INTEGER NOT NULL, '
+                    'message_count INTEGER NOT NULL, '
+                    'first_id INTEGER NOT NULL, '
+                    'last_id INTEGER NOT NULL, '
+                    'last_message_time DATETIME NOT NULL')
+    MIGRATIONS = (
+        ('CREATE INDEX IF NOT EXISTS {tab}_session ON {tab} (session_id, last_id)',),
+    )
+
+    def __iter__(self):
+        """Iterate over all archived runs, returning (session_id, segment, offset, length, message_count)."""
+        return self._iterate_columns('session_id', 'segment', 'offset', 'length', 'message_count',
+                                     order_by='ORDER BY segment, offset')
+
+    def __contains__(self, session):
+        return self._contains('session_id', session)
+
+    def add(self, session, segment, offset, length, message_count, first_id, last_id, last_message_time):
+        """Record an archived run of a session's log.
+
+        :param session: The session ID.
+        :param segment: The file name of the segment.
+        :param offset: Where the run's gzip member starts in the segment, in bytes.
+        :param length: The length of the gzip member, in bytes.
+        :param message_count: The number of log entries in the run.
+        :param first_id: The ID of the first log entry in the run.
+        :param last_id: The ID of the last log entry in the run.
+        :param last_message_time: The time of the last log entry in the run, as a datetime.
+        """
+        with self.cursor as cursor:
+            cursor.execute('INSERT INTO {} VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(self.TABLE_NAME),
+                           (session, segment, offset, length, message_count, first_id, last_id,
+                            int(last_message_time.timestamp())))
+
+    def get(self, session, after=0):
+        """Find the archived runs of a session's log that hold entries after a given one.
+
+        :param session: The session ID.
+        :param after: The ID of the last entry already seen (default: 0, for all of them).
+        :returns: A list of (segment, offset, length), oldest first.
+        """
+        with self.cursor as cursor:
+            return cursor.execute('SELECT segment, offset, length FROM {} WHERE session_id=? AND last_id>? '
+                                  'ORDER BY last_id'.format(self.TABLE_NAME), (session, after)).fetchall()
+
+    def summaries(self, after='', limit=-1):
+        """Summarize the archived conversations, a page at a time, in order of session ID.
+
+        :param after: The session ID at the end of the previous page (default: start from the beginning).
+        :param limit: The most conversations to return, or -1 for no limit (default: -1).
+        :returns: A list of (session_id, message_count, last_message_time).
+        """
+        with self.cursor as cursor:
+            return [(session, count, datetime.fromtimestamp(last_time))
+                    for session, count, last_time in cursor.execute(
+                        'SELECT session_id, SUM(message_count), MAX(last_message_time) FROM {tab} '
+                        'WHERE session_id>? GROUP BY session_id ORDER BY session_id LIMIT ?'.format(
+                            tab=self.TABLE_NAME),
+                        (after, limit))]
 
 
 class Cookies(Storage):
@@ -155,15 +605,49 @@ class Cookies(Storage):
 
 
 class Images(Storage):
-    """Class to store image blobs."""
+    """Class to store images, or where to find them.
+
+    Each image's ETag, a hash of its contents, is computed when it is saved. ``backend`` says where the image
+    itself is: 'database' for the ``image`` blob column, or the name of an image_store backend, which keeps it
+    elsewhere under its ETag. The small columns come before the blob, so they can be read without reading
+    through the blob.
+    """
     TABLE_NAME = 'images'
-    TABLE_SCHEMA = 'img_name TEXT PRIMARY KEY NOT NULL, image BLOB NOT NULL, mimetype TEXT NOT NULL'
+    TABLE_SCHEMA = ('img_name TEXT PRIMARY KEY NOT NULL, '
+                    'mimetype TEXT NOT NULL, '
+                    'etag TEXT, '
+                    'size INTEGER NOT NULL, '
+                    'modified DATETIME NOT NULL, '
+                    "backend TEXT NOT NULL DEFAULT 'database', "
+                    'image BLOB')
+    DATABASE = 'database'
+    MIGRATIONS = (
+        # ETags of existing images are filled in by meta() as they are requested.
+        ('CREATE TABLE {tab}_new (img_name TEXT PRIMARY KEY NOT NULL, mimetype TEXT NOT NULL, etag TEXT, '
+         'size INTEGER NOT NULL, modified DATETIME NOT NULL, image BLOB NOT NULL)',
+         "INSERT INTO {tab}_new SELECT img_name, mimetype, NULL, length(image), "
+         "CAST(strftime('%s', 'now') AS INTEGER), image FROM {tab}",
+         'DROP TABLE {tab}',
+         'ALTER TABLE {tab}_new RENAME TO {tab}'),
+        ("CREATE TABLE {tab}_new (img_name TEXT PRIMARY KEY NOT NULL, mimetype TEXT NOT NULL, etag TEXT, "
+         "size INTEGER NOT NULL, modified DATETIME NOT NULL, backend TEXT NOT NULL DEFAULT 'database', image BLOB)",
+         "INSERT INTO {tab}_new SELECT img_name, mimetype, etag, size, modified, 'database', image FROM {tab}",
+         'DROP TABLE {tab}',
+         'ALTER TABLE {tab}_new RENAME TO {tab}',
+         'CREATE INDEX IF NOT EXISTS {tab}_backend_etag ON {tab} (backend, etag)'),
+    )
+
+    @staticmethod
+    def etag(image):
+        """Compute the ETag of an image from its contents."""
+        return blake2b(image, digest_size=16).hexdigest()
 
     def __getitem__(self, name):
         """Get an image.
 
         :param name: The name of the image.
-        :returns: A tuple containing (The image, as bytes; the mimetype, as str)
+        :returns: A tuple containing (The image, as bytes, or None if another backend keeps it; the mimetype, as
+            str)
         """
         with self.cursor as cursor:
             result = cursor.execute('SELECT image, mimetype FROM {} WHERE img_name=?'.format(self.TABLE_NAME),
@@ -176,6 +660,72 @@ class Images(Storage):
         """Iterate over all known images, returning their names."""
         return self._iterate_column('img_name')
 
+    def etags(self, backend):
+        """Get the ETags of every image kept by a backend.
+
+        :param backend: The name of the backend.
+        :returns: A set of ETags.
+        """
+        with self.cursor as cursor:
+            return {row[0] for row in cursor.execute('SELECT etag FROM {} WHERE backend=?'.format(self.TABLE_NAME),
+                                                     (backend,))}
+
+    def uses(self, etag, backend):
+        """Determine whether any image kept by a backend has an ETag.
+
+        :param etag: The ETag.
+        :param backend: The name of the backend.
+        """
+        with self.cursor as cursor:
+            return cursor.execute('SELECT 1 FROM {} WHERE backend=? AND etag=? LIMIT 1'.format(self.TABLE_NAME),
+                                  (backend, etag)).fetchone() is not None
+
+    def meta(self, name):
+        """Get the details of an image, without reading the image itself.
+
+        :param name: The name of the image.
+        :returns: A tuple of (etag, mimetype, size in bytes, modified datetime, backend), or None if there's no
+            such image.
+        """
+        with self.cursor as cursor:
+            row = cursor.execute('SELECT etag, mimetype, size, modified, backend FROM {} WHERE img_name=?'.format(
+                self.TABLE_NAME), (name,)).fetchone()
+            if row is None:
+                return None
+            etag, mimetype, size, modified, backend = row
+            if etag is None:  # saved to the database before ETags were
+                etag = self.etag(cursor.execute('SELECT image FROM {} WHERE img_name=?'.format(self.TABLE_NAME),
+                                                (name,)).fetchone()[0])
+                cursor.execute('UPDATE {} SET etag=? WHERE img_name=?'.format(self.TABLE_NAME), (etag, name))
+        return etag, mimetype, size, datetime.fromtimestamp(modified), backend
+
+    def names(self, backend):
+        """List the images kept by a backend.
+
+        :param backend: The name of the backend.
+        :returns: A list of image names.
+        """
+        with self.cursor as cursor:
+            return [row[0] for row in cursor.execute('SELECT img_name FROM {} WHERE backend=? ORDER BY img_name'.format(
+                self.TABLE_NAME), (backend,))]
+
+    def read(self, name, start=0, length=-1):
+        """Read part of an image kept in the database.
+
+        :param name: The name of the image.
+        :param start: The offset of the first byte to read (default: 0).
+        :param length: The number of bytes to read, or -1 for the rest of the image (default: -1).
+        :returns: The bytes, or None if there's no such image.
+        """
+        with self.cursor as cursor:
+            if length < 0:
+                row = cursor.execute('SELECT substr(image, ?) FROM {} WHERE img_name=?'.format(self.TABLE_NAME),
+                                     (start + 1, name)).fetchone()
+            else:
+                row = cursor.execute('SELECT substr(image, ?, ?) FROM {} WHERE img_name=?'.format(self.TABLE_NAME),
+                                     (start + 1, length, name)).fetchone()
+        return None if row is None else row[0]
+
     def set(self, name, image, mimetype):
         """Save an image.
 
@@ -184,7 +734,35 @@ class Images(Storage):
         :param mimetype: The mimetype of the image.
         """
         with self.cursor as cursor:
-            cursor.execute('REPLACE INTO {} VALUES (?, ?, ?)'.format(self.TABLE_NAME), (name, image, mimetype))
+            cursor.execute('REPLACE INTO {} (img_name, mimetype, etag, size, modified, backend, image) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)'.format(self.TABLE_NAME),
+                           (name, mimetype, self.etag(image), len(image), int(datetime.now().timestamp()),
+                            self.DATABASE, image))
+
+    def set_elsewhere(self, name, mimetype, etag, size, backend):
+        """Save the details of an image kept by another backend.
+
+        :param name: The name of the image.
+        :param mimetype: The mimetype of the image.
+        :param etag: The ETag of the image, from :meth:`etag`, by which the backend knows it.
+        :param size: The size of the image in bytes.
+        :param backend: The name of the backend.
+        """
+        with self.cursor as cursor:
+            cursor.execute('REPLACE INTO {} (img_name, mimetype, etag, size, modified, backend, image) '
+                           'VALUES (?, ?, ?, ?, ?, ?, NULL)'.format(self.TABLE_NAME),
+                           (name, mimetype, etag, size, int(datetime.now().timestamp()), backend))
+
+    def move(self, name, backend, image=None):
+        """Record that an image has moved to another backend, without changing when it was modified.
+
+        :param name: The name of the image.
+        :param backend: The name of the backend.
+        :param image: The image, as bytes, if it is moving into the database (default: None).
+        """
+        with self.cursor as cursor:
+            cursor.execute('UPDATE {} SET backend=?, image=? WHERE img_name=?'.format(self.TABLE_NAME),
+                           (backend, image, name))
 
     def get(self, name, default=(None, None)):
         """Get an image or return a default value.
@@ -206,6 +784,93 @@ class Images(Storage):
         self._remove('img_name', name)
 
 
+class ImageVariants(Storage):
+    """Class to record the variants made of each image, such as a smaller copy to send by MMS.
+
+    Variants are kept by an image_store backend under their ETags. ``source_etag`` is the ETag of the image each
+    was made from, so variants of an image that has since been replaced can be recognized.
+    """
+    TABLE_NAME = 'image_variants'
+    TABLE_SCHEMA = ('img_name TEXT NOT NULL, '
+                    'variant TEXT NOT NULL, '
+                    'mimetype TEXT NOT NULL, '
+                    'etag TEXT NOT NULL, '
+                    'size INTEGER NOT NULL, '
+                    'modified DATETIME NOT NULL, '
+                    'backend TEXT NOT NULL, '
+                    'source_etag TEXT NOT NULL, '
+                    'PRIMARY KEY (img_name, variant)')
+
+    def delete(self, name):
+        """Forget every variant of an image.
+
+        :param name: The name of the image.
+        """
+        self._remove('img_name', name)
+
+    def etags(self, backend):
+        """Get the ETags of every variant kept by a backend.
+
+        :param backend: The name of the backend.
+        :returns: A set of ETags.
+        """
+        with self.cursor as cursor:
+            return {row[0] for row in cursor.execute('SELECT etag FROM {} WHERE backend=?'.format(self.TABLE_NAME),
+                                                     (backend,))}
+
+    def names(self, variant):
+        """Get the names of the images that have a variant.
+
+        :param variant: The name of the variant.
+        :returns: A set of image names.
+        """
+        with self.cursor as cursor:
+            return {row[0] for row in cursor.execute('SELECT img_name FROM {} WHERE variant=?'.format(self.TABLE_NAME),
+                                                     (variant,))}
+
+    def uses(self, etag, backend):
+        """Determine whether any variant kept by a backend has an ETag.
+
+        :param etag: The ETag.
+        :param backend: The name of the backend.
+        """
+        with self.cursor as cursor:
+            return cursor.execute('SELECT 1 FROM {} WHERE backend=? AND etag=? LIMIT 1'.format(self.TABLE_NAME),
+                                  (backend, etag)).fetchone() is not None
+
+    def meta(self, name, variant):
+        """Get the details of a variant of an image.
+
+        :param name: The name of the image.
+        :param variant: The name of the variant.
+        :returns: A tuple of (etag, mimetype, size in bytes, modified datetime, backend), as from Images.meta, or
+            None if there's no such variant.
+        """
+        with self.cursor as cursor:
+            row = cursor.execute('SELECT etag, mimetype, size, modified, backend FROM {} '
+                                 'WHERE img_name=? AND variant=?'.format(self.TABLE_NAME), (name, variant)).fetchone()
+        if row is None:
+            return None
+        etag, mimetype, size, modified, backend = row
+        return etag, mimetype, size, datetime.fromtimestamp(modified), backend
+
+    def set(self, name, variant, mimetype, etag, size, backend, source_etag):
+        """Record a variant of an image.
+
+        :param name: The name of the image.
+        :param variant: The name of the variant.
+        :param mimetype: The mimetype of the variant.
+        :param etag: The ETag of the variant.
+        :param size: The size of the variant in bytes.
+        :param backend: The name of the backend keeping the variant.
+        :param source_etag: The ETag of the image the variant was made from.
+        """
+        with self.cursor as cursor:
+            cursor.execute('REPLACE INTO {} VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(self.TABLE_NAME),
+                           (name, variant, mimetype, etag, size, int(datetime.now().timestamp()), backend,
+                            source_etag))
+
+
 class Prompts(Storage):
     """Class to store the prompts and defaults of Exchanges."""
     TABLE_NAME = 'prompts'
@@ -216,6 +881,10 @@ class Prompts(Storage):
         """Iterate over the names, prompts, defaults, and types of Exchanges."""
         return self._iterate_columns('name', 'prompt', 'def', 'type', order_by='ORDER BY rank ASC')
 
+    def iter_all(self):
+        """Iterate over the names, prompts, defaults, ranks, and types of Exchanges, in order of rank."""
+        return self._iterate_columns('name', 'prompt', 'def', 'rank', 'type', order_by='ORDER BY rank ASC')
+
     def delete(self, name):
         """Delete an Exchange from the Prompts table.
 
@@ -290,10 +959,13 @@ class Tangents(Storage):
     """Class to store a list of tangents."""
     TABLE_NAME = 'tangents'
     TABLE_SCHEMA = 'id INTEGER PRIMARY KEY NOT NULL, rank INTEGER NOT NULL, tangent TEXT NOT NULL'
+    MIGRATIONS = (
+        ('CREATE INDEX IF NOT EXISTS {tab}_rank ON {tab} (rank, id)',),
+    )
 
     def __iter__(self):
         """Iterate over all tangents yielding (id, rank, tangent)."""
-        return self._iterate_columns('id', 'rank', 'tangent', order_by='ORDER BY rank ASC')
+        return self._iterate_columns('id', 'rank', 'tangent', order_by='ORDER BY rank ASC, id ASC')
 
     def delete(self, id_):
         """Delete a tangent.
@@ -327,6 +999,13 @@ class TangentTracker(Storage):
     """Class to track which tangents have been seen by which users."""
     TABLE_NAME = 'tangent_tracker'
     TABLE_SCHEMA = 'tangent_id INTEGER NOT NULL, user_id TEXT NOT NULL'
+    MIGRATIONS = (
+        ('CREATE INDEX IF NOT EXISTS {tab}_user ON {tab} (user_id, tangent_id)',),
+        # Users were sometimes shown the same tangent twice by concurrent messages; keep one record of each.
+        ('DELETE FROM {tab} WHERE rowid NOT IN (SELECT MIN(rowid) FROM {tab} GROUP BY user_id, tangent_id)',
+         'DROP INDEX IF EXISTS {tab}_user',
+         'CREATE UNIQUE INDEX IF NOT EXISTS {tab}_user_tangent ON {tab} (user_id, tangent_id)'),
+    )
 
     def clear_user(self, user_id):
         """Mark all tangents as unseen by a user.
@@ -347,6 +1026,22 @@ class TangentTracker(Storage):
                     tab=self.TABLE_NAME),
                 (user_id,)).fetchall()
 
+    def next_unseen(self, user_id):
+        """Find the first tangent, in rank order, that a user hasn't seen.
+
+        Tangents are walked through the rank index and each is checked against the user's seen index, stopping
+        at the first unseen one, so nothing is loaded that isn't needed.
+
+        :param user_id: The ID of the user.
+        :returns: The (id, tangent) of the tangent, or None if the user has seen them all.
+        """
+        with self.cursor as cursor:
+            return cursor.execute(
+                'SELECT id, tangent FROM {tangents} WHERE NOT EXISTS '
+                '(SELECT 1 FROM {tab} WHERE user_id=? AND tangent_id={tangents}.id) '
+                'ORDER BY rank ASC, id ASC LIMIT 1'.format(tab=self.TABLE_NAME, tangents=Tangents.TABLE_NAME),
+                (user_id,)).fetchone()
+
     def set_seen(self, tangent_id, user_id):
         """Set a user as having seen a particular tangent.
 
@@ -354,7 +1049,7 @@ class TangentTracker(Storage):
         :param user_id: The user id, a string.
         """
         with self.cursor as cursor:
-            cursor.execute('INSERT INTO {} VALUES (?, ?)'.format(
+            cursor.execute('INSERT OR IGNORE INTO {} VALUES (?, ?)'.format(
                 self.TABLE_NAME),
                 (tangent_id, user_id))
 
@@ -366,6 +1061,15 @@ class Keywords(Storage):
                     'exchange TEXT NOT NULL, '
                     'keyword TEXT NOT NULL, '
                     'destination TEXT NOT NULL')
+    MIGRATIONS = (
+        # get_mapping() let the newest of any duplicate keywords win, so keep that one.
+        ('DELETE FROM {tab} WHERE id NOT IN (SELECT MAX(id) FROM {tab} GROUP BY exchange, keyword)',
+         'CREATE UNIQUE INDEX IF NOT EXISTS {tab}_exchange_keyword ON {tab} (exchange, keyword)'),
+    )
+
+    def __iter__(self):
+        """Iterate over the keywords of all Exchanges, yielding (exchange, keyword, destination)."""
+        return self._iterate_columns('exchange', 'keyword', 'destination', order_by='ORDER BY id ASC')
 
     def delete(self, name):
         """Delete the keywords of an Exchange.
@@ -402,19 +1106,9 @@ class Keywords(Storage):
         :param keyword_map: A dict mapping keywords to Exchanges.
         """
         with self.cursor as cursor:
-            for keyword, destination in keyword_map.items():
-                pre_existing = cursor.execute(
-                    'SELECT destination from {tab} WHERE '
-                    'exchange=? AND keyword=?'.format(
-                        tab=self.TABLE_NAME), (name, keyword)).fetchone()
-                if pre_existing is None:
-                    cursor.execute('INSERT INTO {tab} (exchange, keyword, '
-                                   'destination) VALUES (?, ?, ?)'.format(
-                        tab=self.TABLE_NAME), (name, keyword, destination))
-                elif pre_existing[0] != destination:
-                    cursor.execute('UPDATE {tab} SET destination=? WHERE '
-                                   'exchange=? AND keyword=?'.format(
-                        tab=self.TABLE_NAME), (destination, name, keyword))
+            cursor.executemany('INSERT INTO {tab} (exchange, keyword, destination) VALUES (?, ?, ?) '
+                               'ON CONFLICT (exchange, keyword) DO UPDATE SET destination=excluded.destination'.format(
+                tab=self.TABLE_NAME), ((name, keyword, destination) for keyword, destination in keyword_map.items()))
 
 
 class Secrets(Storage):
@@ -439,11 +1133,30 @@ class Secrets(Storage):
 
 
 class Sessions(Storage):
-    """Class to represent currently known sessions."""
+    """Class to represent currently known sessions.
+
+    Session data is stored encoded by session_codec, as JSON text or as bytes; SQLite keeps bytes in the text
+    column as they are. Whether the session is waiting for an operator is kept apart from the data, as the
+    time it was queued, so the queue can be read from an index without decoding every session.
+    """
     TABLE_NAME = 'sessions'
     TABLE_SCHEMA = ('id TEXT PRIMARY KEY NOT NULL, '
                     'curr_exchange TEXT NOT NULL, '
-                    'data TEXT')
+                    'data TEXT, '
+                    'queued_at REAL')
+    MIGRATIONS = (
+        # Fill queued_at in from the queued flag in either data format: JSON text, or session_codec.CompactCodec
+        # bytes, whose second byte has the flags for "queued" (1) and "queued is true" (2).
+        ('CREATE TABLE {tab}_new (id TEXT PRIMARY KEY NOT NULL, curr_exchange TEXT NOT NULL, data TEXT, '
+         'queued_at REAL)',
+         "INSERT INTO {tab}_new (id, curr_exchange, data, queued_at) SELECT id, curr_exchange, data, "
+         "CASE WHEN typeof(data)='text' AND json_valid(data) AND json_type(data, '$.queued')='true' "
+         "OR typeof(data)='blob' AND hex(substr(data, 1, 2)) IN ('0103', '0107') "
+         "THEN CAST(strftime('%s', 'now') AS REAL) END FROM {tab}",
+         'DROP TABLE {tab}',
+         'ALTER TABLE {tab}_new RENAME TO {tab}',
+         'CREATE INDEX IF NOT EXISTS {tab}_queue ON {tab} (queued_at, id) WHERE queued_at IS NOT NULL'),
+    )
 
     def __iter__(self):
         """Iterate over the Sessions' IDs, current exchanges, and data (possibly None)."""
@@ -461,6 +1174,31 @@ class Sessions(Storage):
             return None, None
         return retval
 
+    def get_many(self, sessions):
+        """Get the states of several sessions in one query.
+
+        :param sessions: An iterable of session identifiers.
+        :returns: A dict mapping the identifiers of the sessions that exist to (exchange, data).
+        """
+        with self.cursor as cursor:
+            return {session: (exchange, data) for session, exchange, data in cursor.execute(
+                'SELECT id, curr_exchange, data FROM {} WHERE id IN (SELECT value FROM json_each(?))'.format(
+                    self.TABLE_NAME), (dumps(list(sessions)),))}
+
+    def ids(self, exchange=None):
+        """List the IDs of sessions, in order.
+
+        :param exchange: Only list sessions currently at this exchange (default: None, for every session).
+        :returns: A list of session IDs.
+        """
+        with self.cursor as cursor:
+            if exchange is None:
+                rows = cursor.execute('SELECT id FROM {} ORDER BY id'.format(self.TABLE_NAME))
+            else:
+                rows = cursor.execute('SELECT id FROM {} WHERE curr_exchange=? ORDER BY id'.format(self.TABLE_NAME),
+                                      (exchange,))
+            return [row[0] for row in rows]
+
     def delete(self, session):
         """Delete a particular session.
 
@@ -468,14 +1206,265 @@ class Sessions(Storage):
         """
         self._remove('id', session)
 
-    def set(self, session, exchange, data=None):
+    def page(self, after='', limit=-1):
+        """Get a page of sessions, in order of ID.
+
+        :param after: The session ID at the end of the previous page (default: start from the beginning).
+        :param limit: The most sessions to return, or -1 for no limit (default: -1).
+        :returns: A list of (id, curr_exchange, data).
+        """
+        with self.cursor as cursor:
+            return cursor.execute('SELECT id, curr_exchange, data FROM {} WHERE id>? ORDER BY id LIMIT ?'.format(
+                self.TABLE_NAME), (after, limit)).fetchall()
+
+    def queue(self, limit=-1):
+        """Get the sessions waiting for an operator, longest waiting first.
+
+        :param limit: The most sessions to return, or -1 for no limit (default: -1).
+        :returns: A list of (id, curr_exchange, data, queued_at).
+        """
+        with self.cursor as cursor:
+            return [(session, exchange, data, datetime.fromtimestamp(queued_at))
+                    for session, exchange, data, queued_at in cursor.execute(
+                        'SELECT id, curr_exchange, data, queued_at FROM {} WHERE queued_at IS NOT NULL '
+                        'ORDER BY queued_at, id LIMIT ?'.format(self.TABLE_NAME), (limit,))]
+
+    def set(self, session, exchange, data=None, queued_at=None):
         """Set the state of a session.
 
         :param session: The session identifier.
         :param exchange: The session's current exchange.
         :param data: Any text data associated with the session.
+        :param queued_at: If the session is waiting for an operator, the time it was queued as an epoch float. A
+            session that was already queued keeps its place.
+        """
+        self.set_many(((session, exchange, data, queued_at),))
+
+    def set_many(self, rows):
+        """Set the states of several sessions with one statement.
+
+        :param rows: An iterable of (session, exchange, data, queued_at), as passed to :meth:`set`.
         """
         with self.cursor as cursor:
-            cursor.execute('REPLACE INTO {} VALUES (?, ?, ?)'.format(
-                self.TABLE_NAME),
-                (session, exchange, data))
+            cursor.executemany('INSERT INTO {} VALUES (?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET '
+                               'curr_exchange=excluded.curr_exchange, data=excluded.data, '
+                               'queued_at=CASE WHEN excluded.queued_at IS NOT NULL THEN '
+                               'coalesce(queued_at, excluded.queued_at) END'.format(self.TABLE_NAME), rows)
+
+    def set_data_many(self, rows):
+        """Replace the data of several sessions at once, leaving their exchanges alone.
+
+        :param rows: An iterable of (session, data).
+        """
+        with self.cursor as cursor:
+            cursor.executemany('UPDATE {} SET data=? WHERE id=?'.format(self.TABLE_NAME),
+                               ((data, session) for session, data in rows))
+
+
+class Versions(Storage):
+    """Class to store version stamps that tell processes when their cached copies of other tables are stale."""
+    TABLE_NAME = 'versions'
+    TABLE_SCHEMA = 'name TEXT PRIMARY KEY NOT NULL, version INTEGER NOT NULL'
+
+    def bump(self, name):
+        """Increment a version stamp.
+
+        Do this in the same transaction as the change it stamps.
+
+        :param name: The name of the version stamp.
+        """
+        with self.cursor as cursor:
+            cursor.execute('INSERT INTO {tab} VALUES (?, 1) '
+                           'ON CONFLICT (name) DO UPDATE SET version=version + 1'.format(tab=self.TABLE_NAME),
+                           (name,))
+
+    def get(self, name):
+        """Get a version stamp.
+
+        :param name: The name of the version stamp.
+        :returns: The version, as an int; 0 if it has never been bumped.
+        """
+        row = self._get_row('name', name, 'version')
+        if row is None:
+            return 0
+        return row[0]
+
+
+class VersionedCache:
+    """Class to keep one process's copy of something built from the database, such as the exchange graph.
+
+    The copy is rebuilt whenever its version stamp falls behind the one on disk, so changes made by any process
+    are picked up on the next lookup. No other process can write during a UnitOfWork, so the version is only
+    checked once per unit of work.
+    """
+
+    def __init__(self, version_name, state_key, build):
+        """Initialize a cache.
+
+        :param version_name: The name of the version stamp.
+        :param state_key: The key to keep the copy under in the state of each UnitOfWork that looks it up.
+        :param build: A function to build a new copy, given the version. The version is read first, so a change
+            made while it runs only causes another rebuild, rather than stale data being stamped as current.
+        """
+        self.version_name = version_name
+        self.state_key = state_key
+        self._build = build
+        self._versions = Versions()
+        self._current = (None, None)  # (version, copy), replaced together
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Get the current copy, rebuilding it if its version stamp has fallen behind."""
+        state = unit_of_work_state()
+        if state is not None and self.state_key in state:
+            return state[self.state_key]
+        version = self._versions.get(self.version_name)
+        current_version, copy = self._current
+        if current_version != version:
+            with self._lock:
+                if self._current[0] != version:
+                    self._current = (version, self._build(version))
+                copy = self._current[1]
+        if state is not None:
+            state[self.state_key] = copy
+        return copy
+
+    def bump(self):
+        """Record a change to the data the copy is built from, so every process rebuilds it.
+
+        Call this in the unit of work that made the change.
+        """
+        self._versions.bump(self.version_name)
+        state = unit_of_work_state()
+        if state is not None:
+            state.pop(self.state_key, None)
+
+
+class Outbox(Storage):
+    """Class to store outbound messages until they have been sent."""
+    TABLE_NAME = 'outbox'
+    TABLE_SCHEMA = ('id INTEGER PRIMARY KEY NOT NULL, '
+                    'recipient TEXT NOT NULL, '
+                    'body TEXT NOT NULL, '
+                    'media TEXT NOT NULL, '
+                    'status TEXT NOT NULL, '
+                    'attempts INTEGER NOT NULL, '
+                    'next_attempt DATETIME NOT NULL, '
+                    'error TEXT')
+    MIGRATIONS = (
+        ("CREATE INDEX IF NOT EXISTS {tab}_pending ON {tab} (recipient, id) WHERE status='pending'",
+         "CREATE INDEX IF NOT EXISTS {tab}_due ON {tab} (next_attempt) WHERE status='pending'"),
+    )
+
+    def claim(self, now, lease, limit):
+        """Claim messages that are due to be sent, at most one per recipient.
+
+        Only the oldest pending message of each recipient is ever claimed, so each recipient gets their messages
+        in order. A claimed message isn't due again until its lease runs out, so if the sender dies without
+        calling :meth:`mark_sent` or :meth:`retry_later`, it is retried.
+
+        :param now: The current time, as an epoch float.
+        :param lease: Seconds to hold the claim for.
+        :param limit: The maximum number of messages to claim.
+        :returns: A list of (id, recipient, body, media JSON, attempts so far).
+        """
+        with self.cursor as cursor:
+            if not cursor.connection.in_transaction:
+                cursor.execute('BEGIN IMMEDIATE')  # so that two processes can't claim the same message
+            rows = cursor.execute(
+                "SELECT id, recipient, body, media, attempts FROM {tab} AS o WHERE status='pending' "
+                "AND next_attempt<=? AND id=(SELECT MIN(id) FROM {tab} WHERE status='pending' "
+                "AND recipient=o.recipient) ORDER BY next_attempt, id LIMIT ?".format(tab=self.TABLE_NAME),
+                (now, limit)).fetchall()
+            cursor.executemany('UPDATE {} SET attempts=attempts + 1, next_attempt=? WHERE id=?'.format(
+                self.TABLE_NAME), ((now + lease, row[0]) for row in rows))
+        return rows
+
+    def enqueue(self, recipient, body, media, now):
+        """Add a message to the outbox.
+
+        :param recipient: The phone number of the recipient.
+        :param body: The text of the message.
+        :param media: A JSON list of image URLs.
+        :param now: The current time, as an epoch float.
+        :returns: The ID of the queued message.
+        """
+        with self.cursor as cursor:
+            cursor.execute("INSERT INTO {} VALUES (NULL, ?, ?, ?, 'pending', 0, ?, NULL)".format(self.TABLE_NAME),
+                           (recipient, body, media, now))
+            return cursor.lastrowid
+
+    def mark_failed(self, id_, error):
+        """Give up on a message.
+
+        :param id_: The ID of the message.
+        :param error: A description of the last error.
+        """
+        with self.cursor as cursor:
+            cursor.execute("UPDATE {} SET status='failed', error=? WHERE id=?".format(self.TABLE_NAME), (error, id_))
+
+    def mark_sent(self, id_):
+        """Record that a message was sent.
+
+        :param id_: The ID of the message.
+        """
+        with self.cursor as cursor:
+            cursor.execute("UPDATE {} SET status='sent', error=NULL WHERE id=?".format(self.TABLE_NAME), (id_,))
+
+    def pending(self):
+        """Count the messages that haven't been sent or given up on yet."""
+        with self.cursor as cursor:
+            return cursor.execute("SELECT Count(*) FROM {} WHERE status='pending'".format(
+                self.TABLE_NAME)).fetchone()[0]
+
+    def progress(self, ids):
+        """Count some messages by status.
+
+        :param ids: An iterable of message IDs.
+        :returns: A dict mapping 'pending', 'sent', and 'failed' to counts.
+        """
+        counts = dict.fromkeys(('pending', 'sent', 'failed'), 0)
+        with self.cursor as cursor:
+            counts.update(cursor.execute('SELECT status, Count(*) FROM {} WHERE id IN (SELECT value FROM json_each(?)) '
+                                         'GROUP BY status'.format(self.TABLE_NAME), (dumps(list(ids)),)))
+        return counts
+
+    def retry_later(self, id_, next_attempt, error):
+        """Reschedule a message after a failed attempt.
+
+        :param id_: The ID of the message.
+        :param next_attempt: When to try again, as an epoch float.
+        :param error: A description of the error.
+        """
+        with self.cursor as cursor:
+            cursor.execute('UPDATE {} SET next_attempt=?, error=? WHERE id=?'.format(self.TABLE_NAME),
+                           (next_attempt, error, id_))
+
+
+class SendPace(Storage):
+    """Class to space out the messages sent from each phone number, across every process that sends them."""
+    TABLE_NAME = 'send_pace'
+    TABLE_SCHEMA = 'sender TEXT PRIMARY KEY NOT NULL, next_slot REAL NOT NULL'
+
+    def get(self, sender):
+        """Get the earliest time the next message from a number may be sent.
+
+        :param sender: The phone number messages are sent from.
+        :returns: The time, as an epoch float; 0.0 if nothing has been sent from the number.
+        """
+        row = self._get_row('sender', sender, 'next_slot')
+        if row is None:
+            return 0.0
+        return row[0]
+
+    def set(self, sender, next_slot):
+        """Set the earliest time the next message from a number may be sent.
+
+        Do this in the same transaction that claims the messages to send, so no two senders get the same slot.
+
+        :param sender: The phone number messages are sent from.
+        :param next_slot: The time, as an epoch float.
+        """
+        with self.cursor as cursor:
+            cursor.execute('INSERT INTO {} VALUES (?, ?) ON CONFLICT (sender) DO UPDATE SET '
+                           'next_slot=excluded.next_slot'.format(self.TABLE_NAME), (sender, next_slot))
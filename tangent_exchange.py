@@ -5,7 +5,7 @@ from session_interface import get_session, set_session
 from tangent_interface import NoTangentsException, get_unseen_tangent
 
 
-def tangent_exchange(session_id, message):
+def tangent_exchange(session_id, message, tokens):
     """Determine whether we're queued or not."""
     curr_exchange, data = get_session(session_id)
     if data.get('queued', False):
@@ -1,19 +1,39 @@
-from storage import TangentTracker, Tangents
+from collections import namedtuple
+from types import MappingProxyType
+
+from storage import TangentTracker, Tangents, UnitOfWork, VersionedCache
 
 TANGENTS = Tangents()
 TRACKER = TangentTracker()
 
+VERSION_NAME = 'tangents'
+
+TangentCatalog = namedtuple('TangentCatalog', ('version', 'ranked', 'by_id'))
+
 
 class NoTangentsException(Exception):
     """Raised when there are no tangents fitting a query."""
 
 
+def _load_catalog(version):
+    ranked = tuple(TANGENTS)
+    return TangentCatalog(version, ranked, MappingProxyType({row[0]: row for row in ranked}))
+
+
+_catalog = VersionedCache(VERSION_NAME, 'tangent_catalog', _load_catalog)
+
+
+def tangent_catalog():
+    """Get the immutable, rank-ordered catalog of all tangents, reloaded whenever any process edits them."""
+    return _catalog.get()
+
+
 def all_tangents():
     """Iterate over all tangents.
 
     :returns: A 3-tuple of (id, rank, tangent).
     """
-    return list(TANGENTS)
+    return tangent_catalog().ranked
 
 
 def delete_tangent(tangent_id):
@@ -21,7 +41,9 @@ def delete_tangent(tangent_id):
 
     :param tangent_id: The ID of the session to clear.
     """
-    TANGENTS.delete(tangent_id)
+    with UnitOfWork():
+        TANGENTS.delete(tangent_id)
+        _catalog.bump()
 
 
 def get_tangent(tangent_id):
@@ -30,10 +52,11 @@ def get_tangent(tangent_id):
     :param tangent_id: The ID of the tangent.
     :returns: A 3-tuple of (id, rank, tangent).
     """
-    row = TANGENTS.get(tangent_id)
-    if row is None:
+    try:
+        tangent_id = int(tangent_id)  # IDs from forms are strings
+    except (TypeError, ValueError):
         return None, None, None
-    return row
+    return tangent_catalog().by_id.get(tangent_id, (None, None, None))
 
 
 def get_unseen_tangent(user_id):
@@ -42,12 +65,11 @@ def get_unseen_tangent(user_id):
     :param user_id: The ID of a user.
     :returns: The text of the first tangent the user hasn't seen.
     """
-    seen = set(thing[0] for thing in TRACKER.get_all_seen(user_id))
-    print(seen)
-    for tangent_id, _, text in all_tangents():
-        if tangent_id not in seen:
-            TRACKER.set_seen(tangent_id, user_id)
-            return text
+    with UnitOfWork():  # so that concurrent messages from the same user can't both pick the same tangent
+        row = TRACKER.next_unseen(user_id)
+        if row is not None:
+            TRACKER.set_seen(row[0], user_id)
+            return row[1]
     raise NoTangentsException('No unseen tangents for user {!r}.'.format(user_id))
 
 
@@ -58,4 +80,6 @@ def set_tangent(rank, tangent_text, tangent_id=None):
     :param tangent_text: The text of the tangent.
     :param tangent_id: The id of a preexisting tangent to modify (default: None).
     """
-    TANGENTS.set(rank, tangent_text, tangent_id)
+    with UnitOfWork():
+        TANGENTS.set(rank, tangent_text, tangent_id)
+        _catalog.bump()
@@ -1,8 +1,38 @@
-from string import ascii_letters, digits
+from re import compile
+from unicodedata import normalize
 
-_VALID_CHARS = ascii_letters + digits + ' '
+ASCII = 'ascii'  # fold accented letters to plain ASCII and drop everything else: 'José' -> 'jose'
+UNICODE = 'unicode'  # keep letters and digits of every script, NFC-normalized and casefolded: 'José' -> 'josé'
+NORMALIZATION = ASCII
+
+# letters that NFKD doesn't split into an ASCII letter and an accent
+_ASCII_FOLDS = str.maketrans({'Æ': 'AE', 'æ': 'ae', 'Ð': 'D', 'ð': 'd', 'Đ': 'D', 'đ': 'd', 'Ł': 'L', 'ł': 'l',
+                              'Ø': 'O', 'ø': 'o', 'Œ': 'OE', 'œ': 'oe', 'ß': 'ss', 'Þ': 'TH', 'þ': 'th'})
+_NOT_CLEAN = compile(r'[^A-Za-z0-9 ]+')
+_NOT_ASCII_WORD = compile(r'[^A-Za-z0-9\s]+')
+_NOT_WORD = compile(r'[^\w\s]+|_+')
 
 
 def clean(s):
     """Clean a string of everything other than ascii letters and digits."""
-    return ''.join(l for l in s if l in _VALID_CHARS)
+    return _NOT_CLEAN.sub('', s)
+
+
+def tokenize(s, normalization=None):
+    """Split a message into normalized words.
+
+    Punctuation is dropped without splitting words apart ("don't" becomes "dont"), and any whitespace separates
+    words. Tokenize a message once and pass the tokens around rather than cleaning it again.
+
+    :param s: The message.
+    :param normalization: ASCII or UNICODE (default: NORMALIZATION).
+    :returns: A tuple of lowercase words.
+    """
+    normalization = normalization or NORMALIZATION
+    if normalization == ASCII:
+        if not s.isascii():
+            s = normalize('NFKD', s.translate(_ASCII_FOLDS))  # split accents off letters so they're dropped below
+        return tuple(_NOT_ASCII_WORD.sub('', s).lower().split())
+    if normalization == UNICODE:
+        return tuple(_NOT_WORD.sub('', normalize('NFC', s)).casefold().split())
+    raise ValueError('Unknown normalization {!r}.'.format(normalization))
@@ -1,19 +1,25 @@
-from functools import wraps
-from re import compile, finditer
-from string import digits
+from datetime import timezone
+from functools import lru_cache, wraps
 
 import requests
-from flask import Flask, Response, jsonify, make_response, redirect, render_template, request, url_for
+from flask import Flask, Response, json, jsonify, make_response, redirect, render_template, request, send_file, \
+    stream_template, stream_with_context, url_for
 from twilio.twiml.messaging_response import Message, MessagingResponse
-from werkzeug.datastructures import Headers
+from werkzeug.datastructures import ContentRange, Headers
+from werkzeug.http import is_resource_modified
 
 import exchange_translation
 import tangent_interface
+from broadcast import broadcast, broadcast_progress, phone_number, select_sessions
+from image_store import image_etags, image_meta, image_path, images_with_variant, read_image, remove_image, \
+    save_image
+from image_transcode import MMS, THUMBNAIL, schedule_variants
+from message_format import parse
 from process_chat import get_prompt, process_chat
-from send_sms import send_message
-from session_interface import all_logged_convos, all_sessions, clear_session as session_clear, get_log, get_session, \
-    has_conversed, set_session
-from storage import Cookies, Images, Secrets
+from send_sms import OUTBOUND, send_message
+from session_interface import LogCursor, all_sessions, clear_session as session_clear, get_session, \
+    has_conversed, logged_convo_summaries, queued_sessions, set_session, subscribe_log
+from storage import Cookies, Images, Secrets, UnitOfWork
 
 app = Flask(__name__)
 
@@ -21,7 +27,15 @@ COOKIES = Cookies()
 SECRETS = Secrets()
 IMAGES = Images()
 
-IMG_REGEX = compile(r'IMAGE\(([^)]+)\)')
+LONG_POLL_LIMIT = 30  # seconds a /stepin_poll request may wait for a new message
+STREAM_KEEPALIVE = 15  # seconds between keepalive comments on an idle /stepin_stream
+IMAGE_CACHE_CONTROL = 'no-cache'  # may be cached, but revalidated each time, as the image may be replaced
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'  # for URLs naming a version of an image
+LOG_PAGE_SIZE = 200  # conversations per page of /logs, and log lines per /stepin_poll or /stepin_stream event
+IMAGE_URL_CACHE_SIZE = 1024
+STREAM_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}  # so proxies pass each event on at once
+
+OUTBOUND.start()
 
 
 def remove_prefix(string, prefix):
@@ -31,14 +45,22 @@ def remove_prefix(string, prefix):
     return string[len(prefix):]
 
 
+def login_redirect():
+    """Get a redirect to the login page if the current request isn't authenticated, else None."""
+    if 'auth' in request.cookies and COOKIES.check(request.cookies['auth']):
+        return None
+    return redirect(url_for('log_in', dest=remove_prefix(request.url, request.url_root)))
+
+
 def authenticated(route):
     """Wrap a function that needs to be authenticated."""
 
     @wraps(route)
     def auth_wrapper(*args, **kwargs):
-        if 'auth' in request.cookies and COOKIES.check(request.cookies['auth']):
-            return route(*args, **kwargs)
-        return redirect(url_for('log_in', dest=remove_prefix(request.url, request.url_root)))
+        response = login_redirect()
+        if response is not None:
+            return response
+        return route(*args, **kwargs)
 
     return auth_wrapper
 
@@ -80,10 +102,13 @@ def new_exchange_post():
                        for keyword, exchange in zip(keywords, target_exchanges)
                        if keyword and exchange}
 
-    if existing:
-        exchange_translation.delete(existing)
-    exchange_translation.save_to_disk(name, prompt, keyword_map, default, rank, type_)
-    return redirect(url_for('exchanges', _anchor=name))
+    with UnitOfWork():
+        if existing:
+            exchange_translation.delete(existing)
+        exchange_translation.save_to_disk(name, prompt, keyword_map, default, rank, type_)
+    missing = [image_name for image_name in exchange_translation.images(name) if image_meta(image_name) is None]
+    error = 'Unknown images in {}: {}'.format(name, ', '.join(missing)) if missing else None
+    return redirect(url_for('exchanges', _anchor=name, **message_dict(error=error)))
 
 
 @app.route('/exchanges', methods=['GET'])
@@ -94,7 +119,10 @@ def exchanges():
     return render_template('exchanges.html',
                            exchanges=all_exchanges,
                            keywords=exchange_translation.keywords,
-                           exch_names=exch_names)
+                           exch_names=exch_names,
+                           exchange_images=exchange_translation.images,
+                           image_names=set(IMAGES),
+                           error=request.values.get('error'))
 
 
 @app.route('/delete_exchange', methods=['POST'])
@@ -140,7 +168,20 @@ def get_chat_message():
 @app.route('/sessions', methods=['GET'])
 @authenticated
 def sessions():
-    return render_template('sessions.html', sessions=all_sessions())
+    if request.values.get('queued') == '1':
+        return render_template('sessions.html', queued_only=True,
+                               sessions=((session_id, exchange, data)
+                                         for session_id, exchange, data, _ in queued_sessions()))
+    return render_template('sessions.html', queued_only=False, sessions=all_sessions())
+
+
+@app.route('/queue', methods=['GET'])
+@authenticated
+def operator_queue():
+    """List the sessions waiting for an operator as JSON, longest waiting first."""
+    limit = request.values.get('limit', -1, type=int)
+    return jsonify([{'session': session_id, 'exchange': exchange, 'data': data, 'queued_at': queued_at.timestamp()}
+                    for session_id, exchange, data, queued_at in queued_sessions(limit)])
 
 
 @app.route('/delete_session', methods=['POST'])
@@ -155,7 +196,11 @@ def clear_session():
 @app.route('/logs', methods=['GET'])
 @authenticated
 def all_logs():
-    return render_template('all_logs.html', logs=all_logged_convos())
+    after = request.values.get('after', '')
+    logs = logged_convo_summaries(after, LOG_PAGE_SIZE + 1)
+    next_after = logs[LOG_PAGE_SIZE - 1][0] if len(logs) > LOG_PAGE_SIZE else None
+    return Response(stream_template('all_logs.html', logs=logs[:LOG_PAGE_SIZE], after=after,  # may be large
+                                    next_after=next_after))
 
 
 @app.route('/viewlog', methods=['GET'])
@@ -203,16 +248,9 @@ def new_session_post():
     if not session_id or not exchange:
         return render_template('new_session.html', all_exchanges=tuple(exchange_translation.all_exchanges()),
                                error='Session ID and exchange are required!')
-    all_digits = set(digits)
-    id_digits = ''.join(d for d in session_id if d in all_digits)
-    bypass = request.values.get('bypass', 'off') == 'on'
-    if bypass:
-        phone_num = '+' + id_digits  # accept it as valid (international?)
-    elif len(id_digits) == 10:
-        phone_num = '+1' + id_digits
-    elif len(id_digits) == 11 and id_digits[0] == '1':
-        phone_num = '+' + id_digits
-    else:
+    bypass = request.values.get('bypass', 'off') == 'on'  # accept it as valid (international?)
+    phone_num = phone_number(session_id, bypass)
+    if phone_num is None:
         return render_template('new_session.html', all_exchanges=tuple(exchange_translation.all_exchanges()),
                                error='Bad phone number! (should be 10 digits)')
     send_prompt = request.values.get('send-prompt', 'on') == 'on'
@@ -231,6 +269,65 @@ def new_session_post():
     return redirect(url_for('new_session'))
 
 
+@app.route('/broadcast', methods=['POST'])
+@authenticated
+def broadcast_post():
+    """Move many sessions to an exchange at once, sending each of them its prompt.
+
+    The JSON body has "exchange", and either "numbers", a list of phone numbers, or "filter", an object with
+    optional "exchange" and "queued" keys choosing among the existing phone sessions. "data" is added to each
+    session's data, "send_prompt" defaults to true, and "bypass" accepts numbers as they are, like on
+    /sessions/new. Pass the "messages" in the response to /broadcast/progress to see how sending is going.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return 'The body must be a JSON object!', 400
+    exchange = body.get('exchange')
+    if exchange is None or ('numbers' in body) == ('filter' in body):
+        return 'Exchange and either numbers or filter must be provided!', 400
+    if 'numbers' in body and not isinstance(body['numbers'], list):
+        return 'Numbers must be a list!', 400
+    if 'filter' in body and not isinstance(body['filter'], dict):
+        return 'Filter must be an object!', 400
+    if not isinstance(body.get('data') or {}, dict):
+        return 'Data must be an object!', 400
+    invalid = []
+    if 'numbers' in body:
+        session_ids = []
+        for number in body['numbers']:
+            session_id = None
+            if isinstance(number, (str, int)) and not isinstance(number, bool):
+                session_id = phone_number(str(number), body.get('bypass', False))
+            if session_id is None:
+                invalid.append(number)
+            else:
+                session_ids.append(session_id)
+    else:
+        session_filter = body['filter']
+        session_ids = select_sessions(session_filter.get('exchange'), session_filter.get('queued', False))
+    try:
+        message_ids = broadcast(session_ids, exchange, request.url, convert_to_twilio_outbound, body.get('data'),
+                                body.get('send_prompt', True))
+    except ValueError as e:
+        return str(e), 400
+    return jsonify(sessions=list(dict.fromkeys(session_ids)), invalid=invalid, messages=message_ids)
+
+
+@app.route('/broadcast/progress', methods=['POST'])
+@authenticated
+def broadcast_progress_post():
+    """Count a broadcast's messages by status. The JSON body has "messages", as returned by /broadcast."""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return 'The body must be a JSON object!', 400
+    message_ids = body.get('messages')
+    if not isinstance(message_ids, list):
+        return 'Messages must be provided as a list!', 400
+    if not all(isinstance(message_id, int) and not isinstance(message_id, bool) for message_id in message_ids):
+        return 'Messages must be message IDs!', 400
+    return jsonify(broadcast_progress(message_ids))
+
+
 @app.route('/send_message', methods=['POST'])
 @authenticated
 def send_manual_message():
@@ -254,16 +351,9 @@ def convert_to_twilio_outbound(text_message, url_base):
     :param url_base: The base URL of this website.
     :returns A dict to be used as kwargs and passed to Client.messages.create.
     """
-    start_ind = 0
-    text_only = []
-    message_images = []
-    for match in finditer(IMG_REGEX, text_message):
-        match_start, match_end = match.span()
-        text_only.append(text_message[start_ind:match_start].strip())
-        message_images.append(url_base + url_for('image', name=match.group(1)))
-        start_ind = match_end
-    text_only.append(text_message[start_ind:])
-    return {'text': ' '.join(text_only), 'images': message_images}
+    parsed = parse(text_message)
+    etags = image_etags()
+    return {'text': parsed.text, 'images': [url_base + image_url(name, MMS, etags) for name in parsed.images]}
 
 
 @app.route('/set_exchange', methods=['POST'])
@@ -321,20 +411,100 @@ def manual_update_key():
 @app.route('/stepin_poll', methods=['GET'])
 @authenticated
 def poll_for_stepin():
-    session_id = request.values.get('session')
-    last_poll = request.values.get('since')
-    if session_id is None or last_poll is None:
-        return 'Session and last poll must be provided!', 400
+    """Get a session's log lines after the one with ID ``after``, as (message, is_from_user, timestamp, id)."""
+    try:
+        cursor, wait = stepin_cursor(request.values), long_poll_wait(request.values)
+    except ValueError as e:
+        return str(e), 400
+
+    with subscribe_log(cursor.session) as subscription:  # subscribe first, so nothing logged meanwhile is missed
+        new_lines = cursor.next_page()
+        if not new_lines and wait > 0 and subscription.get(timeout=wait) is not None:
+            new_lines = cursor.next_page()
+    return jsonify(new_lines)
+
+
+@app.route('/stepin_stream', methods=['GET'])
+@authenticated
+def stream_for_stepin():
+    """Stream a session's log lines after the one with ID ``after`` as Server-Sent Events.
+
+    Each event is a JSON list like /stepin_poll returns, and its ID is the ID of its last line. Lines are always
+    read from the database. A line logged in this process wakes the stream through the message bus as soon as it
+    is committed, and the database is also checked whenever the stream has been idle for STREAM_KEEPALIVE seconds,
+    to find lines logged by other processes.
+    """
+    try:
+        cursor = stepin_cursor(request.values, request.headers.get('Last-Event-ID'))
+    except ValueError as e:
+        return str(e), 400
+
+    def events():
+        with subscribe_log(cursor.session) as subscription:  # subscribe first, so nothing logged meanwhile is missed
+            steps = stepin_events(cursor)
+            event = next(steps)
+            while True:
+                if event is None:
+                    event = steps.send(subscription.get(timeout=STREAM_KEEPALIVE) is None)
+                else:
+                    yield event
+                    event = next(steps)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers=STREAM_HEADERS)
+
+
+def stepin_cursor(values, last_event_id=None):
+    """Read the session and ``after`` parameters of a /stepin_poll or /stepin_stream request.
+
+    :param values: The request's query and form parameters.
+    :param last_event_id: The Last-Event-ID header of a reconnecting stream, which replaces ``after``
+        (default: None).
+    :returns: A LogCursor reading a page of LOG_PAGE_SIZE lines at a time.
+    :raises ValueError: With a message for the client, if a parameter is missing or invalid.
+    """
+    session_id = values.get('session')
+    after = last_event_id or values.get('after')
+    if session_id is None or after is None:
+        raise ValueError('Session and after must be provided!')
+    try:
+        return LogCursor(session_id, int(after), LOG_PAGE_SIZE)
+    except ValueError:
+        raise ValueError('After must be a valid ID!') from None
+
+
+def long_poll_wait(values):
+    """Read the ``wait`` parameter of a /stepin_poll request, in seconds, capped at LONG_POLL_LIMIT.
+
+    :raises ValueError: With a message for the client, if it isn't a number.
+    """
     try:
-        last_poll = float(last_poll)
+        return min(float(values.get('wait', 0)), LONG_POLL_LIMIT)
     except ValueError:
-        return 'Last Poll is not a valid epoch float!', 400
+        raise ValueError('Wait must be a valid float!') from None
+
 
-    return jsonify(time_filter(get_log(session_id), last_poll))
+def stepin_events(cursor):
+    """Generate the Server-Sent Events of a /stepin_stream, one page of log lines at a time.
+
+    The lines are always read from the database, so lines logged by other processes are never skipped. Once it
+    has caught up, the generator yields None; the stream should then wait to be woken by a new line and send
+    whether the wait timed out instead, in which case a keepalive comment is sent if there is still nothing new.
+    """
+    idle = False
+    while True:
+        page = cursor.next_page()
+        if page:
+            idle = False
+            yield server_sent_event(page)
+        else:
+            if idle:
+                yield ': keepalive\n\n'
+            idle = yield None
 
 
-def time_filter(log, after):
-    return [items for items in log if items[2].timestamp() > after]  # filter by timestamp
+def server_sent_event(log_lines):
+    """Format log lines as a Server-Sent Event whose ID is the ID of the last line."""
+    return 'id: {}\ndata: {}\n\n'.format(log_lines[-1][3], json.dumps(log_lines))
 
 
 @app.route('/login', methods=['GET'])
@@ -376,24 +546,29 @@ def redirect_root():
 def sms_reply():
     """Respond to Twilio SMS."""
     session = request.values.get('From')
-    message = request.values.get('Body', '')
 
     if session is None:
         return Response(status=400, response='Error. No phone number.')
     if not has_conversed(session):
         send_welcome_message(session)
 
-    num_media = int(request.values.get('NumMedia', 0))
+    bot_response = process_chat(session, inbound_message(request.values))
+
+    return str(convert_to_twilio(bot_response))
+
+
+def inbound_message(values):
+    """Get the text of an SMS from Twilio, with a line like "USER_IMAGE: url" for each image attached to it.
+
+    :param values: The parameters of Twilio's request, as a mapping.
+    """
+    num_media = int(values.get('NumMedia', 0))
     media = []
     for i in range(num_media):
         media_key = 'MediaUrl{}'.format(i)
-        url = request.values.get(media_key)
+        url = values.get(media_key)
         media.append(url)
-    message = ''.join('USER_IMAGE: {}\n'.format(url) for url in media) + message
-
-    bot_response = process_chat(session, message)
-
-    return str(convert_to_twilio(bot_response))
+    return ''.join('USER_IMAGE: {}\n'.format(url) for url in media) + values.get('Body', '')
 
 
 def convert_to_twilio(text_message):
@@ -406,37 +581,101 @@ def convert_to_twilio(text_message):
     if not text_message:
         return resp
     twilio_message = Message()
-    start_ind = 0
-    for match in finditer(IMG_REGEX, text_message):
-        match_start, match_end = match.span()
-        twilio_message.body(text_message[start_ind:match_start].strip())
-        twilio_message.media(url_for('image', name=match.group(1)))
-        start_ind = match_end
-    twilio_message.body(text_message[start_ind:])
+    parsed = parse(text_message)
+    etags = image_etags()
+    for text, name in zip(parsed.texts, parsed.images):
+        twilio_message.body(text)
+        twilio_message.media(image_url(name, MMS, etags))
+    twilio_message.body(parsed.texts[-1])
     resp.append(twilio_message)
     return resp
 
 
 @app.route('/image', methods=['GET'])
 def image():
-    """Get an image."""
+    """Get an image.
+
+    Responses carry the ETag computed when the image was uploaded, so conditional requests are answered without
+    reading the image, and single byte ranges are supported. Images kept in files are sent by send_file. URLs
+    from image_url() name the version of the image they are for, so they can be cached for as long as anyone
+    likes.
+    """
     name = request.values.get('name')
     if not name:
         return Response(status=400, response='Error. No image name provided.')
-    img_blob, img_mime = IMAGES.get(name)
-    if not img_blob:
+    meta = image_meta(name, request.values.get('variant'))
+    if meta is None:
         return Response(status=400, response='Error. Unknown image {!r}.'.format(name))
+    etag, img_mime, size, modified, _ = meta
+    modified = modified.astimezone(timezone.utc)
+    cache_control = IMMUTABLE_CACHE_CONTROL if request.values.get('v') == etag else IMAGE_CACHE_CONTROL
+    path = image_path(meta)
+    if path is not None:  # let the server send the file itself, where it can
+        response = send_file(path, mimetype=img_mime, etag=etag, last_modified=modified, conditional=True)
+        response.headers.set('Content-Disposition', 'inline', filename=name)
+        response.headers['Cache-Control'] = cache_control
+        return response
+
     headers = Headers()
     headers.add('Content-Disposition', 'inline', filename=name)
-    return Response(img_blob, mimetype=img_mime, headers=headers)
+    headers['Accept-Ranges'] = 'bytes'
+    headers['Cache-Control'] = cache_control
+    response = Response(mimetype=img_mime, headers=headers)
+    response.set_etag(etag)
+    response.last_modified = modified
+    if not is_resource_modified(request.environ, etag=etag, last_modified=modified):
+        response.status_code = 304
+        return response
+
+    byte_range = request.range
+    if byte_range is not None and is_if_range_fresh(request.if_range, etag, modified):
+        span = byte_range.range_for_length(size)
+        if span is None and len(byte_range.ranges) == 1:
+            response.status_code = 416
+            response.headers['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+        if span is not None:
+            start, stop = span
+            response.set_data(read_image(name, meta, start, stop - start))
+            response.status_code = 206
+            response.content_range = ContentRange('bytes', start, stop, size)
+            return response
+    response.set_data(read_image(name, meta))
+    return response
+
+
+def is_if_range_fresh(if_range, etag, modified):
+    """Determine whether a Range request's If-Range condition, if any, still matches the image."""
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return if_range.date == modified
+    return True
+
+
+def image_url(name, variant=None, etags=None):
+    """Get the URL of an image, naming its current version if it exists so that it can be cached for good.
+
+    :param name: The name of the image.
+    :param variant: The variant to ask for, such as MMS (default: None, for the image as uploaded).
+    :param etags: The EtagCache to use, for callers building several URLs (default: image_etags()).
+    """
+    return _image_url(request.script_root, name, variant, (etags or image_etags()).get(name, variant))
+
+
+@lru_cache(maxsize=IMAGE_URL_CACHE_SIZE)
+def _image_url(script_root, name, variant, etag):  # the script root is part of the URL, so part of the key
+    if etag is None:
+        return url_for('image', name=name, variant=variant)
+    return url_for('image', name=name, variant=variant, v=etag)
 
 
 @app.route('/images', methods=['GET'])
 @authenticated
 def images():
-    """View and edit images."""
-    return render_template('images.html', images=IMAGES, success=request.values.get('success'),
-                           error=request.values.get('error'))
+    """View and edit images. Only those with a thumbnail are previewed, so the page never loads full-size images."""
+    return render_template('images.html', images=IMAGES, thumbnail=THUMBNAIL, thumbnails=images_with_variant(THUMBNAIL),
+                           success=request.values.get('success'), error=request.values.get('error'))
 
 
 def message_dict(**kwargs):
@@ -456,7 +695,7 @@ def upload_image():
 def delete_image():
     to_delete = request.values.get('image')
     if to_delete:
-        IMAGES.remove(to_delete)
+        remove_image(to_delete)
     return redirect(url_for('images', success='Deleted {!r}.'.format(to_delete)))
 
 
@@ -475,7 +714,8 @@ def process_image():
         return '', 'Not an image.'
     img_blob = image_file.read()
     img_name = request.values.get('image_name') or image_file.filename
-    IMAGES.set(name=img_name, image=img_blob, mimetype=mimetype)
+    save_image(img_name, img_blob, mimetype)
+    schedule_variants(img_name)
     return 'Successfully uploaded image {!r}.'.format(img_name), ''
 
 
@@ -520,17 +760,30 @@ def delete_tangent():
     return redirect(url_for('tangents'))
 
 
-def send_welcome_message(phone_num):
+def welcome_request(phone_num):
+    """Get the request that asks the welcome chatbot to welcome someone.
+
+    :param phone_num: The phone number of the person to welcome.
+    :returns: A 2-tuple of (url, form data), or None if no welcome chatbot is configured.
+    """
     try:
         url = SECRETS['welcome_url']
         exchange = SECRETS['welcome_exchange_name']
         password = SECRETS['welcome_system_password']
     except KeyError:
+        return None
+    return url, {'phone_num': phone_num,
+                 'exchange': exchange,
+                 'password': password}
+
+
+def send_welcome_message(phone_num):
+    welcome = welcome_request(phone_num)
+    if welcome is None:
         return
+    url, data = welcome
     try:
-        requests.post(url, data={'phone_num': phone_num,
-                                 'exchange': exchange,
-                                 'password': password})
+        requests.post(url, data=data)
     except requests.exceptions.RequestException:
         return
 